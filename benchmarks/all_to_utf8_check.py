@@ -0,0 +1,175 @@
+"""
+=== DESCRIPTION
+Checks corpus_cleaning/all_to_utf8.py on a synthetic crawl of short subtitle
+    files, in the encodings crawled files come in:
+    japanese     utf8, utf8 with a bom, utf16, cp932, euc-jp, iso-2022-jp
+    english      ascii, utf8, cp1252 (curly quotes, accents; each cp1252
+                 directory also gets a file that strictly decodes as cp932)
+    chinese      gb2312, mixed into japanese directories to tempt the directory
+                 cache. what these come out as is up to chardet, so they're
+                 only counted, not checked
+
+Most files in a directory share its encoding, as they would coming from one
+    source; the rest are random, so the directory cache gets wrong guesses
+    to recover from. all_to_utf8.py is run over a copy the way it's used
+    (find | python all_to_utf8.py), and every file is compared with the text
+    it was made from. Files all_to_utf8.py couldn't place are left as they
+    were, and only counted; any file rewritten into something different is
+    printed and the script exits 1.
+
+For comparison, also counts the files chardet alone (the old detection) gets wrong.
+
+=== USAGE
+python all_to_utf8_check.py --dirs 30 --files 20 --jobs 4
+    optional: --work_dir [dir, kept afterwards] --seed [n]
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+import collections
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../corpus_cleaning/all_to_utf8.py')
+sys.path.append(os.path.dirname(SCRIPT))
+import all_to_utf8
+
+
+JA_WORDS = [u'\u3053\u308c', u'\u305d\u308c', u'\u5927\u4e08\u592b', u'\u3042\u308a\u304c\u3068\u3046',
+            u'\u672c\u5f53\u306b', u'\u884c\u3053\u3046', u'\u5f85\u3063\u3066', u'\u4f55\u3060',
+            u'\u79c1\u306f', u'\u5f7c\u5973\u304c', u'\u5148\u751f', u'\u5b66\u6821\u3067',
+            u'\u4eca\u65e5\u306f', u'\u660e\u65e5', u'\u77e5\u3089\u306a\u3044', u'\u3067\u3059\u304b',
+            u'\u3054\u3081\u3093\u306a\u3055\u3044', u'\u3059\u307f\u307e\u305b\u3093', u'\u304a\u9858\u3044',
+            u'\u5206\u304b\u3063\u305f', u'\u30c6\u30ec\u30d3', u'\u30b3\u30fc\u30d2\u30fc', u'\u30c9\u30a2',
+            u'\u3001', u'\u3002', u'\uff01', u'\uff1f', u'\u266a', u'\u2026', u'\uff08\u7b11\uff09',
+            u'\u300c', u'\u300d']
+ZH_WORDS = [u'\u6211\u4eec', u'\u5728', u'\u8fd9\u91cc', u'\u5403\u996d', u'\u4ed6\u4eec', u'\u5b66\u6821',
+            u'\u5b66\u4e60', u'\u4e2d\u6587', u'\u4f60\u597d', u'\u4ec0\u4e48', u'\u6ca1\u6709', u'\u77e5\u9053',
+            u'\u73b0\u5728', u'\u65f6\u5019', u'\u95ee\u9898', u'\uff0c', u'\u3002', u'\uff1f']
+EN_WORDS = ['you', 'what', 'know', 'right', 'okay', 'going', 'there', 'sorry', 'hello', 'please',
+            'never', 'mother', 'school', 'money', 'sure', 'fine', 'worry', 'late', '-', '...', '!', '?']
+CP1252_WORDS = [u'I\u2019m', u'don\u2019t', u'it\u2019s', u'you\u2019re', u'\u201creally\u201d', u'caf\xe9',
+                u'Pok\xe9mon', u'na\xefve', u'\u2014', u'\u2026']
+# every non-ascii byte followed by a letter: strictly decodes as cp932, all kanji
+CP1252_KANJI = u'I\u2019m sure it\u2019s fine. Don\u2019t worry. You\u2019re late, Pok\xe9mon.'
+
+# (language, encoding) a file can be; directories take one as their main encoding
+KINDS = [('ja', 'utf-8'), ('ja', 'utf-8-sig'), ('ja', 'utf-16'), ('ja', 'cp932'), ('ja', 'euc_jp'),
+         ('ja', 'iso2022_jp'), ('en', 'ascii'), ('en', 'cp1252'), ('en', 'utf-8')]
+
+
+def process_command_line():
+    parser = argparse.ArgumentParser(description='usage')
+    parser.add_argument('--dirs', dest='dirs', type=int, default=30, help='directories in the crawl')
+    parser.add_argument('--files', dest='files', type=int, default=20, help='files per directory')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=4, help='all_to_utf8.py worker processes')
+    parser.add_argument('--work_dir', dest='work_dir', type=str, default=None, help='where to write the crawl')
+    parser.add_argument('--seed', dest='seed', type=int, default=0, help='random seed')
+    return parser.parse_args()
+
+
+def subtitle(rng, lang):
+    """ a short srt in lang, as unicode
+    """
+    blocks = []
+    for i in range(rng.randint(2, 40)):
+        if lang == 'ja':
+            text = u''.join(rng.choice(JA_WORDS) for _ in range(rng.randint(2, 8)))
+        elif lang == 'zh':
+            text = u''.join(rng.choice(ZH_WORDS) for _ in range(rng.randint(2, 8)))
+        else:
+            words = [rng.choice(EN_WORDS) for _ in range(rng.randint(2, 8))]
+            if lang == 'en_cp1252':
+                words.insert(rng.randint(0, len(words)), rng.choice(CP1252_WORDS))
+            text = u' '.join(words)
+        blocks.append(u'%d\n00:%02d:%02d,000 --> 00:%02d:%02d,500\n%s\n' % (
+            i + 1, i // 60, i % 60, i // 60, i % 60, text))
+    return u'\n'.join(blocks)
+
+
+def generate(root, dirs, files, rng):
+    """ writes the crawl under root
+
+        returns: {path: (original bytes, expected bytes after conversion, language)}
+    """
+    expected = {}
+    for d in range(dirs):
+        main = KINDS[d % len(KINDS)]
+        path = os.path.join(root, 'd%03d' % d)
+        os.makedirs(path)
+        for f in range(files):
+            lang, encoding = main if rng.random() < 0.8 else rng.choice(KINDS)
+            if lang == 'ja' and rng.random() < 0.1:
+                lang, encoding = 'zh', 'gb2312'
+            text = subtitle(rng, 'en_cp1252' if encoding == 'cp1252' else lang)
+            data = text.encode(encoding)
+            # a utf8 bom is kept, as it always was
+            out = data if encoding == 'utf-8-sig' else text.encode('utf8')
+            fp = os.path.join(path, '%03d.srt' % f)
+            with open(fp, 'wb') as fh:
+                fh.write(data)
+            expected[fp] = (data, out, lang)
+        if main == ('en', 'cp1252'):
+            text = u'1\n00:00:00,000 --> 00:00:02,000\n%s\n' % CP1252_KANJI
+            fp = os.path.join(path, 'cp932_lookalike.srt')
+            with open(fp, 'wb') as fh:
+                fh.write(text.encode('cp1252'))
+            expected[fp] = (text.encode('cp1252'), text.encode('utf8'), 'en')
+    return expected
+
+
+def chardet_only(data):
+    """ returns: the utf8 the old, chardet-only detection would have written, or None
+    """
+    try:
+        return data.decode(all_to_utf8.get_charset(data)).encode('utf8')
+    except Exception:
+        return None
+
+
+if __name__ == '__main__':
+    args = process_command_line()
+    root = args.work_dir or tempfile.mkdtemp(prefix='all_to_utf8_check_')
+    try:
+        expected = generate(os.path.join(root, 'crawl'), args.dirs, args.files, random.Random(args.seed))
+        files = sorted(expected)
+        total = sum(len(data) for data, _, _ in expected.values())
+
+        start = time.time()
+        proc = subprocess.Popen([sys.executable, SCRIPT, '--quiet', '--jobs', str(args.jobs)],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        summary = proc.communicate(''.join(fp + '\n' for fp in files))[0]
+        elapsed = max(time.time() - start, 1e-9)
+        if proc.returncode != 0:
+            print 'all_to_utf8.py FAILED (exit %d)' % proc.returncode
+            sys.exit(1)
+        for line in summary.splitlines():
+            if line.startswith(('DONE', 'DETECTED BY')):
+                print line
+
+        wrong, left, chinese = [], [], collections.Counter()
+        for fp in files:
+            original, out, lang = expected[fp]
+            with open(fp, 'rb') as f:
+                data = f.read()
+            if lang == 'zh':
+                chinese['right' if data == out else 'left as they were' if data == original else 'wrong'] += 1
+            elif data != out:
+                (left if data == original else wrong).append(fp)
+        for fp in wrong[:20]:
+            print 'WRONG: %s (was %r...)' % (fp, expected[fp][0][40:80])
+        old_wrong = sum(1 for data, out, lang in expected.values() if lang != 'zh' and chardet_only(data) != out)
+        checked = len(files) - sum(chinese.values())
+
+        print 'all_to_utf8.py    %d of %d files wrong, %d left as they were, %.1f files/sec, %.2f MB/sec' % (
+            len(wrong), checked, len(left), len(files) / elapsed, total / 1e6 / elapsed)
+        print 'chardet alone     %d of %d files wrong' % (old_wrong, checked)
+        print 'chinese files     %s' % ', '.join('%d %s' % (n, k) for (k, n) in sorted(chinese.items()))
+        if wrong:
+            sys.exit(1)
+        print 'NO FILES CONVERTED WRONGLY'
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(root, ignore_errors=True)
@@ -0,0 +1,122 @@
+"""
+=== DESCRIPTION
+Checks char_filter.keep_safe against the per-character safe() filter it replaces,
+    then times both on a synthetic english sample.
+
+Equivalence is checked on every byte, every unicode code point, and every line of
+    the sample (as utf8 bytes and as unicode); any mismatch is printed and the
+    script exits 1.
+
+The sample is subtitle-like english: words, digits, punctuation both kept and
+    dropped, leading dashes, the odd accented or japanese character, and
+    fullwidth / superscript digits (which unicode isdigit() accepts).
+
+=== USAGE
+python char_filter_bench.py --lines 200000 --repeats 3
+"""
+import os
+import sys
+import time
+import random
+import argparse
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../corpus_cleaning'))
+from char_filter import safe, keep_safe
+
+
+WORDS = ['the', 'you', 'what', 'know', 'right', 'okay', 'going', 'there', 'about', 'really',
+         'tonight', 'captain', 'sorry', 'hello', 'please', 'never', 'mother', 'school', 'money']
+NOISE = [u'-', u'...', u'"', u'*', u'<i>', u'</i>', u'\u266a', u'\u2026', u'caf\xe9', u'na\xefve',
+         u'\u3042\u308a\u304c\u3068\u3046', u'\uff11\uff12', u'x\xb2', u'~', u'@', u'\t', u'/']
+PUNCTUATION = [u'!', u'?', u',', u'.', u':', u';', u"'s", u'(laughs)', u'[door]', u'{\\an8}', u'$5', u'50%']
+
+
+def process_command_line():
+    parser = argparse.ArgumentParser(description='usage')
+    parser.add_argument('--lines', dest='lines', type=int, default=200000, help='lines in the sample')
+    parser.add_argument('--repeats', dest='repeats', type=int, default=3, help='runs per filter, best is kept')
+    parser.add_argument('--seed', dest='seed', type=int, default=0, help='random seed')
+    return parser.parse_args()
+
+
+def sample_lines(n, seed=0):
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(n):
+        parts = []
+        if rng.random() < 0.3:
+            parts.append(u'- ')
+        for _ in range(rng.randint(1, 12)):
+            r = rng.random()
+            if r < 0.75:
+                parts.append(rng.choice(WORDS) + u' ')
+            elif r < 0.85:
+                parts.append(u'%d ' % rng.randint(0, 2000))
+            elif r < 0.95:
+                parts.append(rng.choice(PUNCTUATION) + u' ')
+            else:
+                parts.append(rng.choice(NOISE) + u' ')
+        lines.append(u''.join(parts).strip() + u'\n')
+    return lines
+
+
+def per_char(line):
+    return ''.join(c for c in line if safe(c))
+
+
+def check_equivalence(lines):
+    """ returns: [(what, input)] where keep_safe and per_char disagree
+    """
+    mismatches = []
+    for i in range(256):
+        c = chr(i)
+        if keep_safe(c) != per_char(c):
+            mismatches.append(('byte', c))
+    for i in range(sys.maxunicode + 1):
+        c = unichr(i)
+        if keep_safe(c) != (c if safe(c) else u''):
+            mismatches.append(('code point', c))
+    for line in lines:
+        encoded = line.encode('utf8')
+        if keep_safe(encoded) != per_char(encoded):
+            mismatches.append(('utf8 line', encoded))
+        if keep_safe(line) != per_char(line):
+            mismatches.append(('unicode line', line))
+    return mismatches
+
+
+def best_time(fn, lines, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.time()
+        for line in lines:
+            fn(line)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == '__main__':
+    args = process_command_line()
+    lines = sample_lines(args.lines, args.seed)
+
+    mismatches = check_equivalence(lines)
+    if mismatches:
+        for what, x in mismatches[:20]:
+            print 'MISMATCH ON %s: %r' % (what, x)
+        print '%d MISMATCHES' % len(mismatches)
+        sys.exit(1)
+    print 'EQUIVALENT on 256 bytes, %d code points, %d lines' % (sys.maxunicode + 1, len(lines))
+
+    encoded = [line.encode('utf8') for line in lines]
+    megabytes = sum(len(line) for line in encoded) / 1e6
+    print '%-22s %10s %14s %10s' % ('FILTER', 'SECONDS', 'LINES/S', 'MB/S')
+    results = {}
+    for name, fn, sample in [('per_char (bytes)', per_char, encoded), ('keep_safe (bytes)', keep_safe, encoded),
+                             ('per_char (unicode)', per_char, lines), ('keep_safe (unicode)', keep_safe, lines)]:
+        seconds = best_time(fn, sample, args.repeats)
+        results[name] = seconds
+        print '%-22s %10.4f %14.0f %10.2f' % (name, seconds, len(sample) / max(seconds, 1e-9),
+                                              megabytes / max(seconds, 1e-9))
+    print 'SPEEDUP: %.1fx on bytes, %.1fx on unicode' % (
+        results['per_char (bytes)'] / max(results['keep_safe (bytes)'], 1e-9),
+        results['per_char (unicode)'] / max(results['keep_safe (unicode)'], 1e-9))
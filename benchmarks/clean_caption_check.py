@@ -0,0 +1,135 @@
+"""
+=== DESCRIPTION
+Checks utils.clean_caption against the original implementation it replaced
+    (kept below, verbatim, as original_clean_caption), then times both.
+
+Inputs are fuzzed captions built from the pieces the cleaner's patterns care
+    about: fullwidth parens and arrows, actor names, markup and brackets,
+    site signatures, urls, escaped and real newlines / tabs / returns, the
+    encoding-error marker, runs of spaces, mixed case, and japanese text.
+    Every caption is checked as unicode, and ascii ones also as byte strings.
+    Any mismatch is printed and the script exits 1.
+
+=== USAGE
+python clean_caption_check.py --captions 300000 --repeats 3
+"""
+import os
+import re
+import sys
+import time
+import random
+import argparse
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../corpus_generation'))
+from utils import clean_caption
+
+
+def original_clean_caption(x):
+    """ cleans a caption
+    """
+    x = x.strip()                            # strip ends
+    x = x.lower()                            # lowercase
+
+    ja_parens      = re.compile('\xef\xbc\x88.*?\xef\xbc\x89')
+    ja_rightarrow  = re.compile('\xe2\x86\x92')
+    actor          = re.compile('[\w ]+:')
+    unwanted       = re.compile('[*#]')
+    brackets       = re.compile('\<.*?\>|{.*?}|\(.*?\)')
+    newlines       = re.compile('\\\\n|\n')
+    site_signature = re.compile('.*subtitles.*\n?|.*subs.*\n?', re.IGNORECASE)
+    urls           = re.compile('www.*\s\n?|[^\s]*\. ?com\n?')
+    msc            = re.compile('\\\\|\t|\\\\t|\r|\\\\r')
+    encoding_error = re.compile('0000,0000,0000,\w*?')
+    multi_space    = re.compile('[ ]+')
+
+    # to and from unicode for regex to work
+    x = unicode(ja_parens.sub('', x.encode('utf8')), 'utf8')
+    x = unicode(ja_rightarrow.sub('', x.encode('utf8')), 'utf8')
+    x = actor.sub('', x)
+    x = unwanted.sub('', x)
+    x = brackets.sub('', x)
+    x = site_signature.sub('', x)
+    x = urls.sub('', x)
+    x = msc.sub('', x)
+    x = encoding_error.sub('', x)
+    x = newlines.sub(' ', x)
+    x = multi_space.sub(' ', x)
+    x = x.strip()
+
+    return x
+
+
+PIECES = [
+    u'hello', u'WORLD', u'Going', u'there', u'okay', u'what?', u'no!', u'123', u'_x_',
+    u'\u3053\u3093\u306b\u3061\u306f', u'\u65e5\u672c\u8a9e', u'\u30c6\u30ec\u30d3',
+    u'\uff08', u'\uff09', u'\uff08\u7b11\uff09', u'\u2192', u'\u2190',
+    u'JOHN:', u'Mary Ann:', u':', u'*', u'#', u'<i>', u'</i>', u'<', u'>', u'{\\an8}', u'{', u'}',
+    u'(', u')', u'(laughs)', u'subs', u'Subtitles by', u'SUBS', u'www.example', u'site.com',
+    u'a. com', u'.com', u'\\n', u'\n', u'\\N', u'\t', u'\\t', u'\r', u'\\r', u'\\',
+    u'0000,0000,0000,', u'0000,0000,0000,ab', u'  ', u'   ', u' ', u'-', u'...', u'\xe9', u'\xa0',
+]
+
+
+def process_command_line():
+    parser = argparse.ArgumentParser(description='usage')
+    parser.add_argument('--captions', dest='captions', type=int, default=300000, help='fuzzed captions')
+    parser.add_argument('--repeats', dest='repeats', type=int, default=3, help='timing runs, best is kept')
+    parser.add_argument('--seed', dest='seed', type=int, default=0, help='random seed')
+    return parser.parse_args()
+
+
+def fuzz(n, seed=0):
+    rng = random.Random(seed)
+    captions = []
+    for _ in range(n):
+        parts = [rng.choice(PIECES) for _ in range(rng.randint(0, 12))]
+        joiner = rng.choice([u' ', u'', u' ', u'\n'])
+        captions.append(joiner.join(parts))
+    return captions
+
+
+def check(captions):
+    """ returns: [(input, expected, got)] where the two cleaners disagree
+    """
+    mismatches = []
+    for x in captions:
+        inputs = [x]
+        try:
+            inputs.append(x.encode('ascii'))
+        except UnicodeEncodeError:
+            pass
+        expected = original_clean_caption(x)
+        for y in inputs:
+            got = clean_caption(y)
+            if got != expected:
+                mismatches.append((y, expected, got))
+    return mismatches
+
+
+def best_time(fn, captions, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.time()
+        for x in captions:
+            fn(x)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == '__main__':
+    args = process_command_line()
+    captions = fuzz(args.captions, args.seed)
+    mismatches = check(captions)
+    if mismatches:
+        for x, expected, got in mismatches[:20]:
+            print 'MISMATCH ON %r: expected %r, got %r' % (x, expected, got)
+        print '%d MISMATCHES' % len(mismatches)
+        sys.exit(1)
+    print 'EQUIVALENT on %d captions' % len(captions)
+
+    sample = captions[:min(len(captions), 100000)]
+    old = best_time(original_clean_caption, sample, args.repeats)
+    new = best_time(clean_caption, sample, args.repeats)
+    print '%-24s %10.4f s  %10.0f captions/s' % ('original_clean_caption', old, len(sample) / max(old, 1e-9))
+    print '%-24s %10.4f s  %10.0f captions/s' % ('clean_caption', new, len(sample) / max(new, 1e-9))
+    print 'SPEEDUP: %.1fx' % (old / max(new, 1e-9))
@@ -0,0 +1,221 @@
+"""
+=== DESCRIPTION
+Benchmarks the alignment pipeline on a synthetic crawl (see synthetic.py),
+    with translations served by stub_worker.py, so no ./trans is needed.
+
+Stages:
+    clean_caption           every ja and en caption, uncached
+    tf_idf                  TF_IDF construction for each en file, cold caches
+    get_caption_matches     positional window matching, per pair
+    get_caption_matches_band   timestamp-banded matching, per pair
+    solve_v3                full solve (matching + filtering), per pair
+    extract_subs            parser_v4.extract_subs end to end, per ja file
+                            (guessit, translation over the worker pipe, alignment)
+
+Each stage reports its best time over --repeats runs, captions/sec, and the
+    process's peak RSS so far. Results can be saved as a baseline and compared
+    against later.
+
+=== USAGE
+python run_benchmarks.py --captions 2000 --drift 1.001 --save_baseline baseline.json
+python run_benchmarks.py --captions 2000 --drift 1.001 --baseline baseline.json
+    optional: --work_dir [dir] --titles [n] --episodes [n] --offset [ms] --repeats [n]
+              --stages [comma separated] --tolerance [fraction] --out [results json]
+"""
+import os
+import sys
+import gc
+import json
+import time
+import resource
+import argparse
+import tempfile
+import shutil
+import collections
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../corpus_generation'))
+import synthetic
+import utils
+import tf_idf
+import srt_reader
+from subfile_aligner import Aligner
+from translator import WorkerTranslator
+
+
+STAGES = ['clean_caption', 'tf_idf', 'get_caption_matches', 'get_caption_matches_band',
+          'solve_v3', 'extract_subs']
+
+
+def process_command_line():
+    parser = argparse.ArgumentParser(description='usage')
+    parser.add_argument('--work_dir', dest='work_dir', type=str, default=None,
+                        help='where to generate the synthetic crawl (default: a temp dir, removed afterwards)')
+    parser.add_argument('--titles', dest='titles', type=int, default=1, help='synthetic titles')
+    parser.add_argument('--episodes', dest='episodes', type=int, default=2, help='ja/en pairs per title')
+    parser.add_argument('--captions', dest='captions', type=int, default=1000, help='captions per file')
+    parser.add_argument('--drift', dest='drift', type=float, default=1.001, help='en time / ja time')
+    parser.add_argument('--offset', dest='offset', type=int, default=3000, help='en - ja time offset (ms)')
+    parser.add_argument('--band', dest='band', type=int, default=2000, help='time band for the banded stage (ms)')
+    parser.add_argument('--repeats', dest='repeats', type=int, default=3, help='runs per stage, best is kept')
+    parser.add_argument('--stages', dest='stages', type=str, default=','.join(STAGES), help='stages to run')
+    parser.add_argument('--baseline', dest='baseline', type=str, default=None, help='baseline json to compare with')
+    parser.add_argument('--save_baseline', dest='save_baseline', type=str, default=None,
+                        help='write these results as a baseline json')
+    parser.add_argument('--tolerance', dest='tolerance', type=float, default=0.10,
+                        help='slowdown (fraction) vs the baseline that counts as a regression')
+    parser.add_argument('--out', dest='out', type=str, default=None, help='write results json here')
+    return parser.parse_args()
+
+
+class Quiet():
+    """ swallows the aligner's progress prints while a stage runs
+    """
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = self
+
+
+    def __exit__(self, *exc):
+        sys.stdout = self.stdout
+
+
+    def write(self, s):
+        pass
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def cold_caches():
+    utils.CLEAN_CACHE.clear()
+    tf_idf.IDF_CACHE.clear()
+    srt_reader.PARSED.clear()
+
+
+def time_stage(fn, repeats, setup=None):
+    """ returns: best wall time of fn() over repeats, each after setup()
+    """
+    best = None
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        gc.collect()
+        start = time.time()
+        with Quiet():
+            fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(args):
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='jesc_bench_')
+    try:
+        return run_in(args, work_dir)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_in(args, work_dir):
+    data, translations, pairs = synthetic.generate(work_dir, args.titles, args.episodes, args.captions,
+                                                   args.drift, args.offset)
+    worker_cmd = '%s %s %s' % (sys.executable,
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stub_worker.py'),
+                               translations)
+    stages = args.stages.split(',')
+    ja_captions = sum(len(srt_reader.parse_srt(ja)) for (ja, _) in pairs)
+    en_captions = sum(len(srt_reader.parse_srt(en)) for (_, en) in pairs)
+    results = collections.OrderedDict()
+
+    def record(name, seconds, captions):
+        results[name] = {'seconds': seconds, 'captions': captions,
+                         'captions_per_sec': captions / max(seconds, 1e-9), 'peak_rss_mb': peak_rss_mb()}
+
+    if 'clean_caption' in stages:
+        texts = []
+        for ja, en in pairs:
+            texts += srt_reader.parse_srt(ja).texts() + srt_reader.parse_srt(en).texts()
+        record('clean_caption', time_stage(lambda: [utils.clean_caption(t) for t in texts], args.repeats),
+               len(texts))
+
+    if 'tf_idf' in stages:
+        record('tf_idf', time_stage(lambda: [tf_idf.TF_IDF(en) for (_, en) in pairs], args.repeats, cold_caches),
+               en_captions)
+
+    translator = WorkerTranslator(worker_cmd)
+    try:
+        aligners = []
+        if set(stages) & set(['get_caption_matches', 'get_caption_matches_band', 'solve_v3']):
+            with Quiet():
+                for ja, en in pairs:
+                    a = Aligner(ja, translator)
+                    a.load(en)
+                    aligners.append(a)
+        if 'get_caption_matches' in stages:
+            record('get_caption_matches',
+                   time_stage(lambda: [a.get_caption_matches() for a in aligners], args.repeats), ja_captions)
+        if 'get_caption_matches_band' in stages:
+            record('get_caption_matches_band',
+                   time_stage(lambda: [a.get_caption_matches(band=args.band) for a in aligners], args.repeats),
+                   ja_captions)
+        if 'solve_v3' in stages:
+            record('solve_v3', time_stage(lambda: [list(a.solve_v3()) for a in aligners], args.repeats),
+                   ja_captions)
+    finally:
+        translator.close()
+
+    if 'extract_subs' in stages:
+        import parser_v4
+        import translator as translator_module
+        parser_args = argparse.Namespace(trans_worker=worker_cmd, trans_cache=None, trans_cache_size=1000000,
+                                         trans_jobs=1, trans_timeout=60, solver='v3', time_band=None, index_dir=None, pipeline=False)
+
+        def extract():
+            for ja, _ in pairs:
+                title_root = os.path.dirname(os.path.dirname(ja))
+                parser_v4.extract_subs(ja, title_root, parser_args, en_cache={})
+
+        try:
+            record('extract_subs', time_stage(extract, args.repeats, cold_caches), ja_captions)
+        finally:
+            for t in translator_module.TRANSLATORS.values():
+                t.close()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ prints each stage against the baseline
+
+        returns: [stages that regressed]
+    """
+    regressions = []
+    print '%-26s %10s %14s %10s %10s' % ('STAGE', 'SECONDS', 'CAPTIONS/S', 'RSS MB', 'VS BASE')
+    for name, r in results.items():
+        change = ''
+        if baseline and name in baseline:
+            ratio = r['seconds'] / max(baseline[name]['seconds'], 1e-9)
+            change = '%+.1f%%' % ((ratio - 1) * 100)
+            if ratio > 1 + tolerance:
+                change += ' REGRESSION'
+                regressions.append(name)
+        print '%-26s %10.4f %14.0f %10.1f %10s' % (name, r['seconds'], r['captions_per_sec'], r['peak_rss_mb'], change)
+    return regressions
+
+
+if __name__ == '__main__':
+    args = process_command_line()
+    results = run(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    for path in [args.out, args.save_baseline]:
+        if path:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=2)
+    if regressions:
+        print 'REGRESSIONS: ', ', '.join(regressions)
+        sys.exit(1)
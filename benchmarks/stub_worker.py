@@ -0,0 +1,27 @@
+"""
+=== DESCRIPTION
+A translation worker (see WORKER PROTOCOL in corpus_generation/translator.py)
+    that looks captions up in a translations table written by synthetic.py.
+    Unknown captions get an empty translation.
+
+=== USAGE
+python parser_v4.py ... --trans_worker "python benchmarks/stub_worker.py [translations.json]"
+"""
+import sys
+import json
+
+
+def main(path):
+    with open(path, 'rb') as f:
+        table = json.load(f)
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        ja = line.rstrip('\n').decode('utf8')
+        sys.stdout.write(table.get(ja, u'').encode('utf8') + '\n')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
@@ -0,0 +1,148 @@
+"""
+=== DESCRIPTION
+Generates a synthetic crawl of paired ja/en subtitles, laid out the way
+    parser_v4 expects (root/title/{ja,en}/*.srt), along with a translations
+    table that stub_worker.py serves.
+
+en captions are random sentences over a made-up vocabulary. Each ja caption is
+    the same sentence in pseudo-japanese, made by spelling every word in kana
+    and dropping the spaces. ja timings are the en timings mapped through
+    (t - offset) / drift, plus jitter. Some captions are dropped on either
+    side, and translations are noisy (words dropped or swapped).
+
+=== USAGE
+python synthetic.py [out_dir] --titles 2 --episodes 3 --captions 1000 --drift 1.001 --offset 3000
+    writes [out_dir]/data/... and [out_dir]/translations.json
+"""
+import os
+import sys
+import json
+import bisect
+import random
+import argparse
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../corpus_generation'))
+from utils import clean_caption
+from translator import normalize_ja
+
+
+KANA = [unichr(c) for c in range(0x30a2, 0x30f3)]   # katakana a..n
+
+
+def process_command_line():
+    parser = argparse.ArgumentParser(description='usage')
+    parser.add_argument('out_dir', metavar='out_dir', type=str, help='where to write the synthetic crawl')
+    parser.add_argument('--titles', dest='titles', type=int, default=2, help='number of titles')
+    parser.add_argument('--episodes', dest='episodes', type=int, default=3, help='ja/en pairs per title')
+    parser.add_argument('--captions', dest='captions', type=int, default=1000, help='captions per en file')
+    parser.add_argument('--drift', dest='drift', type=float, default=1.001, help='en time / ja time')
+    parser.add_argument('--offset', dest='offset', type=int, default=3000, help='en - ja time offset (ms)')
+    parser.add_argument('--seed', dest='seed', type=int, default=0, help='random seed')
+    return parser.parse_args()
+
+
+class Vocabulary():
+    """ made-up en words, each with a fixed kana spelling
+    """
+    def __init__(self, rng, size=2000):
+        syllables = ['ka', 'ri', 'to', 'me', 'su', 'no', 'ha', 'ru', 'ki', 'mo', 'ta', 'ne', 'yo', 'shi']
+        words = set()
+        while len(words) < size:
+            words.add(''.join(rng.choice(syllables) for _ in range(rng.randint(1, 4))))
+        self.words = sorted(words)
+        self.kana = dict((w, u''.join(rng.choice(KANA) for _ in range(rng.randint(2, 5)))) for w in self.words)
+        # zipf-ish word frequencies, so tf-idf has common and rare words to work with
+        self.cumulative = []
+        total = 0.0
+        for rank in range(len(self.words)):
+            total += 1.0 / (rank + 1)
+            self.cumulative.append(total)
+
+
+    def sentence(self, rng):
+        return [self.weighted(rng) for _ in range(rng.randint(2, 8))]
+
+
+    def weighted(self, rng):
+        i = bisect.bisect_left(self.cumulative, rng.random() * self.cumulative[-1])
+        return self.words[min(i, len(self.words) - 1)]
+
+
+def format_time(ms):
+    ms = max(0, int(ms))
+    return '%02d:%02d:%02d,%03d' % (ms // 3600000, ms // 60000 % 60, ms // 1000 % 60, ms % 1000)
+
+
+def write_srt(path, captions):
+    """ captions: [(start ms, end ms, text)]
+    """
+    with open(path, 'wb') as f:
+        for i, (start, end, text) in enumerate(captions):
+            f.write('%d\n%s --> %s\n%s\n\n' % (i + 1, format_time(start), format_time(end), text.encode('utf8')))
+
+
+def noisy_translation(rng, words, vocab, p_drop=0.2, p_swap=0.1):
+    out = []
+    for w in words:
+        r = rng.random()
+        if r < p_drop:
+            continue
+        out.append(rng.choice(vocab.words) if r < p_drop + p_swap else w)
+    return ' '.join(out)
+
+
+def make_pair(rng, vocab, n, drift=1.001, offset=3000, p_drop=0.05):
+    """ returns: (en captions, ja captions, {normalized ja: translation})
+    """
+    en, ja, table = [], [], {}
+    t = rng.randint(1000, 30000)
+    for _ in range(n):
+        words = vocab.sentence(rng)
+        duration = rng.randint(800, 4000)
+        if rng.random() >= p_drop:
+            en.append((t, t + duration, u' '.join(words)))
+        if rng.random() >= p_drop:
+            jitter = rng.randint(-150, 150)
+            start = (t - offset) / drift + jitter
+            ja_text = u''.join(vocab.kana[w] for w in words)
+            ja.append((start, start + duration / drift, ja_text))
+            table[normalize_ja(clean_caption(ja_text))] = noisy_translation(rng, words, vocab)
+        t += duration + rng.randint(50, 2000)
+    return en, ja, table
+
+
+def generate(out_dir, titles=2, episodes=3, captions=1000, drift=1.001, offset=3000, seed=0):
+    """ writes a synthetic crawl to out_dir/data, and the translation table to
+        out_dir/translations.json
+
+        returns: (data dir, translations path, [(ja srt, en srt)])
+    """
+    rng = random.Random(seed)
+    vocab = Vocabulary(rng)
+    data = os.path.join(out_dir, 'data')
+    table = {}
+    pairs = []
+    for i in range(titles):
+        title = 'synthetic_title_%d' % i
+        for lang in ['ja', 'en']:
+            d = os.path.join(data, title, lang)
+            if not os.path.isdir(d):
+                os.makedirs(d)
+        for e in range(1, episodes + 1):
+            en, ja, translations = make_pair(rng, vocab, captions, drift, offset)
+            table.update(translations)
+            ja_srt = os.path.join(data, title, 'ja', '%s.S01E%02d.ja.srt' % (title, e))
+            en_srt = os.path.join(data, title, 'en', '%s.S01E%02d.en.srt' % (title, e))
+            write_srt(ja_srt, ja)
+            write_srt(en_srt, en)
+            pairs.append((ja_srt, en_srt))
+    translations = os.path.join(out_dir, 'translations.json')
+    with open(translations, 'wb') as f:
+        json.dump(table, f)
+    return data, translations, pairs
+
+
+if __name__ == '__main__':
+    args = process_command_line()
+    data, translations, pairs = generate(args.out_dir, args.titles, args.episodes, args.captions,
+                                         args.drift, args.offset, args.seed)
+    print 'WROTE %d PAIRS TO %s, TRANSLATIONS IN %s' % (len(pairs), data, translations)
@@ -1,60 +1,245 @@
 """
-Many subtitle files have weird ass encodings like SHIFT-JIS. 
+Many subtitle files have weird ass encodings like SHIFT-JIS.
 This python script replaces every file it's piped with good 'ole UTF-8 .
 
+Each file is decoded and re-encoded in memory and swapped in with an atomic
+    rename. A file is left alone if it doesn't fully decode as its guessed
+    charset, so a bad guess can't truncate anything.
+
+Nearly every crawled file is utf8, utf16, shift-jis (cp932), euc-jp or
+    iso-2022-jp, so those are checked for first, in order:
+    bom        a utf8/16/32 byte order mark
+    iso2022    iso-2022-jp escape sequences, and the file decodes as it
+    utf8       the file strictly decodes as utf8
+    cached     the file decodes as the japanese charset last found in its
+               directory (files in a directory usually share a source), and
+               the result looks japanese (see jp_score)
+    jp         the file decodes as cp932 or euc-jp, and the result looks
+               japanese (mostly kana, kanji and cjk punctuation, with enough
+               kana); the best scoring one is remembered for the directory
+    chardet    otherwise, chardet's guess from the first 10 lines
+
+The directory cache only ever holds cp932 or euc-jp, and only decides which
+    of the two is scored first. other multibyte charsets (gb2312, big5,
+    euc-kr...) strictly decode plenty of euc-jp, and single byte ones decode
+    anything, so a cached one of those would win over files that are japanese.
+
 === EXAMPLE USAGE: recursively converts everything in given directory:
 find ~/Dir/with/files/ -type f | python all_to_utf8.py
+    optional: --jobs [processes, default: all cores] --quiet
+    prints how many files were detected each way, and files/sec and MB/sec
 
 """
 import sys
 import os
+import re
+import time
+import codecs
+import argparse
+import tempfile
+import collections
+import multiprocessing
+from multiprocessing import Pool
+import chardet
 from tqdm import tqdm
-from multiprocessing import Process
 
 
+# how much of a file the charset is guessed from (chardetect used to see `head`)
+PREFIX_LINES = 10
+
+BOMS = [
+    ('\xff\xfe\x00\x00', 'utf-32'),
+    ('\x00\x00\xfe\xff', 'utf-32'),
+    ('\xef\xbb\xbf', 'utf-8'),    # kept, as it always was
+    ('\xff\xfe', 'utf-16'),
+    ('\xfe\xff', 'utf-16'),
+]
+
+# iso-2022-jp's shifts into jis x 0208 / 0212 / roman / ascii
+ISO2022_ESCAPES = re.compile(r'\x1b(?:\$[@B]|\$\(D|\([BJ])')
+
+JP_CANDIDATES = ['cp932', 'euc_jp']
+NON_ASCII = re.compile(u'[^\x00-\x7f]')
+# what japanese subtitles are made of: kana, kanji, cjk & fullwidth punctuation,
+#   and the odd general punctuation or symbol (quotes, dashes, ellipses, music notes, shapes)
+JP_CHARS = re.compile(u'[\u3000-\u30ff\u4e00-\u9fff\uff01-\uff5e\u2010-\u206f\u2190-\u21ff'
+                      u'\u25a0-\u25ff\u2600-\u26ff]')
+# kana proper: kanji alone prove nothing, since cp932 decodes most 2-byte runs of
+#   cp1252 (e.g. the \x92 of "I\x92m") into kanji
+KANA = re.compile(u'[\u3040-\u30ff]')
+JP_SAMPLE = 20000      # characters scored
+JP_THRESHOLD = 0.9     # fraction of non-ascii characters that have to look japanese
+KANA_THRESHOLD = 0.2   # fraction of non-ascii characters that have to be kana
+
+# this worker's directory => last japanese charset found there
+DIR_CHARSETS = {}
+
+
+def process_command_line():
+    parser = argparse.ArgumentParser(description='usage')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='worker processes')
+    parser.add_argument('--quiet', dest='quiet', action='store_true', default=False,
+                        help='only print the summary')
+    return parser.parse_args()
+
+
+def prefix(data, lines=PREFIX_LINES):
+    end = -1
+    for _ in range(lines):
+        end = data.find('\n', end + 1)
+        if end < 0:
+            return data
+    return data[:end + 1]
+
+
+def get_charset(data):
+    """ detect encoding of a file's contents
+    """
+    charset = chardet.detect(prefix(data))['encoding']
+    if charset is None:
+        raise ValueError('no charset guess')
+    return charset.upper()
+
+
+def codec_name(charset):
+    try:
+        return codecs.lookup(charset).name
+    except LookupError:
+        return None
+
+
+def write_atomic(fp, data):
+    """ replaces fp's contents, via a tmp file in the same directory + rename
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fp) or '.', suffix='.utf8')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp, os.stat(fp).st_mode & 0777)
+        os.rename(tmp, fp)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def jp_score(text):
+    """ fraction of text's non-ascii characters that japanese subtitles would use,
+        or 0 if too few of them are kana. wrong decodes come out as halfwidth
+        katakana (euc-jp read as cp932), kanji and symbols without any kana
+        around them (cp1252 read as cp932), or private use characters
+    """
+    sample = text[:JP_SAMPLE]
+    non_ascii = len(NON_ASCII.findall(sample))
+    if non_ascii == 0 or len(KANA.findall(sample)) < KANA_THRESHOLD * non_ascii:
+        return 0.0
+    return len(JP_CHARS.findall(sample)) / float(non_ascii)
 
 
-def to_utf8(fp, encodings):
+def try_decode(data, codec):
+    try:
+        return data.decode(codec)
+    except UnicodeDecodeError:
+        return None
+
+
+def decode(data, fp):
+    """ returns: (text, charset, how it was detected)
+    """
+    for bom, codec in BOMS:
+        if data.startswith(bom):
+            return data.decode(codec), codec.upper(), 'bom'
+
+    if '\x1b' in data and ISO2022_ESCAPES.search(data):
+        text = try_decode(data, 'iso2022_jp')
+        if text is not None:
+            return text, 'ISO-2022-JP', 'iso2022'
+    else:
+        # most files are utf8 already, and a strict utf8 decode is all the proof that needs
+        text = try_decode(data, 'utf8')
+        if text is not None:
+            return text, 'UTF-8', 'utf8'
+
+    d = os.path.dirname(fp)
+    cached = DIR_CHARSETS.get(d)
+    scored = []
+    # cp932 and euc-jp can each decode a fair bit of the other, so the cached one still has to look right
+    for codec in sorted(JP_CANDIDATES, key=lambda c: c != cached):
+        text = try_decode(data, codec)
+        if text is None:
+            continue
+        score = jp_score(text)
+        if codec == cached and score >= JP_THRESHOLD:
+            return text, codec.upper(), 'cached'
+        scored.append((score, codec, text))
+    if scored:
+        score, codec, text = max(scored)
+        if score >= JP_THRESHOLD:
+            DIR_CHARSETS[d] = codec
+            return text, codec.upper(), 'jp'
+
+    charset = get_charset(data)
+    codec = codec_name(charset)
+    if codec is None:
+        raise LookupError('unsupported charset %s' % charset)
+    if codec == 'iso8859-1':
+        # chardet says iso-8859-1 for cp1252 whose prefix has no curly quotes or dashes;
+        #   iso-8859-1's \x80-\x9f are control characters no subtitle has
+        text = try_decode(data, 'cp1252')
+        if text is not None:
+            return text, 'WINDOWS-1252', 'chardet'
+    text = data.decode(codec)
+    if codec in JP_CANDIDATES:
+        DIR_CHARSETS[d] = codec
+    return text, charset, 'chardet'
+
+
+def to_utf8(fp):
     """Given a file path, converts that file in-place to utf-8
+
+       returns: (fp, 'converted' / 'unchanged' / 'skipped', charset or error,
+                 how the charset was detected, bytes read)
     """
-    def get_charset(fp):
-        """ detect encoding of a file """
-        # TODO - LOCKING ON head.tmp
-        tmp = os.system('head %s > head.tmp' % fp)
-        output = os.popen('chardetect head.tmp').read()
-        os.system('rm head.tmp')        
-        charset = output.split(':')[1].strip().split(' ')[0]
-        return charset.upper()
-
-    # if that character set is supported by iconv, convert it
+    data = ''
     try:
-        charset = get_charset(fp)
-        if charset in encodings:
-            os.system('iconv -f %s -t UTF-8 "%s" > "%s"' % (charset, fp, fp + '.utf8'))
-            os.system('mv "%s" "%s"' % (fp + '.utf8', fp))
-            print 'CONVERTED \n\t to "%s" \n\t encoding was: %s' % (fp, charset)
-        else:
-            raise Exception
-    except Exception:
-        print 'SKIPPED \n\t %s' % fp
+        with open(fp, 'rb') as f:
+            data = f.read()
+        text, charset, how = decode(data, fp)
+        converted = text.encode('utf8')
+        if converted == data:
+            return fp, 'unchanged', charset, how, len(data)
+        write_atomic(fp, converted)
+        return fp, 'converted', charset, how, len(data)
+    except Exception as e:
+        return fp, 'skipped', '%s: %s' % (type(e).__name__, e), None, len(data)
 
 
 if __name__ == '__main__':
-    # get supported encodings
-    os.system('iconv -l > tmp')
-    supported_encodings = [w.upper() for l in open('tmp').readlines() for w in l.strip().split()]
-
-    # run concurrently 
-    MAX_PROCESSES = 4
-    processes = set()
-    files = [line.strip() for line in sys.stdin]
-
-    for file in tqdm(files):
-        p = Process(target=to_utf8, args=(file, supported_encodings,))
-        p.start()
-        processes.add(p)
-        while len(processes) >= MAX_PROCESSES:
-            processes.difference_update([p for p in processes if not p.is_alive()])
-
-    # cleanup
-    os.system('rm tmp')
+    args = process_command_line()
+    files = [line.strip() for line in sys.stdin if line.strip()]
+    outcomes = collections.Counter()
+    detected = collections.Counter()
+    total_bytes = 0
+    start = time.time()
+    pool = Pool(args.jobs)
+    # files arrive grouped by directory (find order); chunks keep neighbours on
+    #   the same worker, so its directory cache gets used
+    chunksize = max(1, min(64, len(files) // (args.jobs * 4) or 1))
+    for fp, outcome, charset, how, size in tqdm(pool.imap_unordered(to_utf8, files, chunksize), total=len(files)):
+        outcomes[outcome] += 1
+        detected[how or 'failed'] += 1
+        total_bytes += size
+        if args.quiet or outcome == 'unchanged':
+            continue
+        if outcome == 'converted':
+            print 'CONVERTED \n\t to "%s" \n\t encoding was: %s' % (fp, charset)
+        else:
+            print 'SKIPPED \n\t %s (%s)' % (fp, charset)
+    pool.close()
+    pool.join()
+    elapsed = max(time.time() - start, 1e-9)
+    print 'DONE: ', ', '.join('%s %d' % (k, n) for (k, n) in sorted(outcomes.items()))
+    print 'DETECTED BY: ', ', '.join('%s %d' % (k, n) for (k, n) in sorted(detected.items()))
+    print 'THROUGHPUT: %d files, %.1f MB in %.1fs (%.1f files/sec, %.2f MB/sec, %d jobs)' % (
+        len(files), total_bytes / 1e6, elapsed, len(files) / elapsed, total_bytes / 1e6 / elapsed, args.jobs)
@@ -0,0 +1,67 @@
+"""
+=== DESCRIPTION
+The character filter postprocessing.py applies to english lines: roman letters,
+    digits, spaces and a little punctuation are kept, everything else dropped.
+
+safe() is the per-character definition. keep_safe() applies it to a whole line
+    in one pass: str.translate with a table of the bytes to delete for (utf8)
+    byte strings, and a compiled character class for unicode (built on first
+    use, since it spells out every code point isdigit() accepts).
+
+=== USAGE
+keep_safe('- caf\xc3\xa9, 3 dogs!')    => 'caf, 3 dogs!'
+"""
+import re
+import sys
+
+
+VALID_PUNCTUATION = '!#$%&(),.:;?\'[]{}'
+
+
+def is_alpha(c):
+    try:
+        return c.encode('ascii').isalpha()
+    except:
+        return False
+
+
+def safe(char):
+    """ tests whether a char is a valid roman character
+    """
+    if is_alpha(char):
+        return True
+
+    if char in VALID_PUNCTUATION:
+        return True
+
+    if char == ' ':
+        return True
+
+    if char.isdigit():
+        return True
+
+    return False
+
+
+ALL_BYTES = ''.join(chr(i) for i in range(256))
+UNSAFE_BYTES = ''.join(c for c in ALL_BYTES if not safe(c))
+
+UNSAFE_UNICODE = None
+
+
+def unsafe_unicode():
+    global UNSAFE_UNICODE
+    if UNSAFE_UNICODE is None:
+        # past ascii, only isdigit() can pass (superscripts, fullwidth digits, ...)
+        keep = [unichr(i) for i in range(128) if safe(unichr(i))]
+        keep += [unichr(i) for i in range(128, sys.maxunicode + 1) if unichr(i).isdigit()]
+        UNSAFE_UNICODE = re.compile(u'[^%s]' % u''.join(re.escape(c) for c in keep), re.UNICODE)
+    return UNSAFE_UNICODE
+
+
+def keep_safe(line):
+    """ line without its unsafe characters, i.e. ''.join(c for c in line if safe(c))
+    """
+    if isinstance(line, unicode):
+        return unsafe_unicode().sub(u'', line)
+    return line.translate(None, UNSAFE_BYTES)
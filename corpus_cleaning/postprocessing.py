@@ -6,6 +6,13 @@ non-english examples, etc
 
 === USAGE
 python postprocessing.py [en file] [ja file] > output
+    optional: --jobs [processes, default: all cores] --chunk_lines [lines per task]
+              --verdicts [file from word_verdicts.py] --verdict_cache_size [words]
+
+Both files are streamed in chunks of lines, which a pool of processes (each with
+    its own enchant dictionary) cleans; output comes out in input order, and only
+    a few chunks per process are ever in memory. Dictionary checks go through
+    a cache of word verdicts (see word_verdicts.py).
 
 === INPUTS
 "en file" and "ja file" are 1-phrase-per-line parallel text files
@@ -18,108 +25,132 @@ The en and ja phrases in this file are tab-separated
 """
 import string
 import sys
+import os
+import argparse
+import itertools
+import collections
+import multiprocessing
+from multiprocessing import Pool
 from tqdm import tqdm
 import enchant
 import re
 
-dictionary = enchant.Dict("en_US")
-VALID_PUNCTUATION = '!#$%&(),.:;?\'[]{}'
-
+# share the caption cleaner with corpus_generation
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'corpus_generation'))
+from utils import clean_caption
+from word_verdicts import WordVerdicts, split_words
+from char_filter import keep_safe
 
-def clean_caption(x):
-    """ cleans a caption (from corpus_generation/utils.py)
-    """
-    x = x.strip()                            # strip ends                                                      
-    x = x.lower()                            # lowercase                                                            
-    
-    ja_parens      = re.compile('\xef\xbc\x88.*?\xef\xbc\x89')
-    ja_rightarrow  = re.compile('\xe2\x86\x92')
-    actor          = re.compile('[\w ]+:')
-    unwanted       = re.compile('[*#]')    
-    brackets       = re.compile('\<.*?\>|{.*?}|\(.*?\)')
-    newlines       = re.compile('\\\\n|\n')
-    site_signature = re.compile('.*subtitles.*\n?|.*subs.*\n?', re.IGNORECASE)
-    urls           = re.compile('www.*\s\n?|[^\s]*\. ?com\n?')
-    msc            = re.compile('\\\\|\t|\\\\t|\r|\\\\r')
-    encoding_error = re.compile('0000,0000,0000,\w*?')
-    multi_space    = re.compile('[ ]+')
-
-    # to and from unicode for regex to work
-    x = unicode(ja_parens.sub('', x.encode('utf8')), 'utf8')
-    x = unicode(ja_rightarrow.sub('', x.encode('utf8')), 'utf8')
-    x = actor.sub('', x)
-    x = unwanted.sub('', x)
-    x = brackets.sub('', x)
-    x = site_signature.sub('', x)
-    x = urls.sub('', x)
-    x = msc.sub('', x)
-    x = encoding_error.sub('', x)
-    x = newlines.sub(' ', x)
-    x = multi_space.sub(' ', x)
-    x = x.strip()
-    
-    return x
+# this process's dictionary, behind a verdict cache (see init_worker)
+WORDS = None
 
 
 def percent_english_words(l):
     """ gets the percent fo whitespace-seperated chunks that are english words 
     """
-    l = ''.join(c for c in l if c not in string.punctuation)
-    words = l.split(' ')
+    words = split_words(l)
     en_count = 0.0
     i = 0
     for word in words:
-        try:
-            if dictionary.check(word.strip()):
-                en_count += 1
-        except:
-            pass
+        if WORDS.check(word.strip()):
+            en_count += 1
         i += 1.0
 
     percent = en_count/i if i != 0 else 0
     return percent
 
 
-def is_alpha(c):
-    try:
-        return c.encode('ascii').isalpha()
-    except:
-        return False
-
-
-def safe(char):
-    """ tests whether a char is a valid roman character
-    """
-    if is_alpha(char):
-        return True
+def process_command_line():
+    parser = argparse.ArgumentParser(description='usage')
+    parser.add_argument('en', metavar='en', type=str, help='english side, one phrase per line')
+    parser.add_argument('ja', metavar='ja', type=str, help='japanese side, one phrase per line')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='worker processes (1 runs everything in this process)')
+    parser.add_argument('--verdicts', dest='verdicts', type=str, default=None,
+                        help='precomputed word verdicts, from word_verdicts.py')
+    parser.add_argument('--verdict_cache_size', dest='verdict_cache_size', type=int, default=100000,
+                        help='recent word verdicts each process remembers')
+    parser.add_argument('--chunk_lines', dest='chunk_lines', type=int, default=5000,
+                        help='lines per task handed to a worker')
+    return parser.parse_args()
 
-    if char in VALID_PUNCTUATION:
-        return True
 
-    if char == ' ':
-        return True
+def init_worker(verdicts=None, cache_size=100000):
+    global WORDS
+    WORDS = WordVerdicts(enchant.Dict("en_US"), verdicts, cache_size)
 
-    if char.isdigit():
-        return True
 
-    return False
+def postprocess(en_l, ja_l):
+    """ returns: the output line for a pair, or None if it's dropped
+    """
+    cleaned_line = en_l.strip('- ').lstrip('.)] ').rstrip(',([ ')
+    cleaned_line = keep_safe(en_l).strip().lstrip('.')
+    cleaned_line = cleaned_line.replace('  ', ' ').lower().rstrip(',')
+    cleaned_line = clean_caption(cleaned_line).encode('utf8')   # unicode out, ja_l is utf8 bytes
 
+    ja_cleaned = ja_l.lstrip('- ').strip()
 
-en = open(sys.argv[1])
-en_lines = en.readlines()
+    if len(cleaned_line) >= 2 and percent_english_words(cleaned_line) > 0.4:
+        return '%s\t%s\n' % (cleaned_line, ja_cleaned)
+    return None
 
-ja = open(sys.argv[2])
-ja_lines = ja.readlines()
 
+def postprocess_chunk(pairs):
+    """ returns: (output text for a chunk of pairs, number of pairs)
+    """
+    out = []
+    for en_l, ja_l in pairs:
+        line = postprocess(en_l, ja_l)
+        if line is not None:
+            out.append(line)
+    return ''.join(out), len(pairs)
 
-for en_l, ja_l in tqdm(zip(en_lines, ja_lines)):
-    cleaned_line = en_l.strip('- ').lstrip('.)] ').rstrip(',([ ')
-    cleaned_line = ''.join(c for c in en_l if safe(c)).strip().lstrip('.')
-    cleaned_line = cleaned_line.replace('  ', ' ').lower().rstrip(',')
-    cleaned_line = clean_caption(cleaned_line)
 
-    ja_cleaned = ja_l.lstrip('- ').strip()
+def read_chunks(en_path, ja_path, chunk_lines):
+    """ yields [(en line, ja line)] chunks, stopping at the end of the shorter file
+    """
+    pairs = itertools.izip(open(en_path), open(ja_path))
+    while True:
+        chunk = list(itertools.islice(pairs, chunk_lines))
+        if len(chunk) == 0:
+            return
+        yield chunk
 
-    if len(cleaned_line) >= 2 and percent_english_words(cleaned_line) > 0.4:
-        print '%s\t%s' % (cleaned_line, ja_cleaned)
 
+def ordered_imap(pool, fn, tasks, window):
+    """ like pool.imap, but with at most window tasks in flight (pool.imap reads
+        its whole input up front, which would defeat streaming)
+    """
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.apply_async(fn, (task,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def main(args):
+    chunks = read_chunks(args.en, args.ja, args.chunk_lines)
+    pool = None
+    if args.jobs > 1:
+        pool = Pool(args.jobs, initializer=init_worker, initargs=(args.verdicts, args.verdict_cache_size))
+        results = ordered_imap(pool, postprocess_chunk, chunks, window=args.jobs * 2)
+    else:
+        init_worker(args.verdicts, args.verdict_cache_size)
+        results = itertools.imap(postprocess_chunk, chunks)
+
+    progress = tqdm(unit=' lines')
+    try:
+        for out, n in results:
+            sys.stdout.write(out)
+            progress.update(n)
+    finally:
+        progress.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+if __name__ == '__main__':
+    main(process_command_line())
@@ -0,0 +1,142 @@
+"""
+=== DESCRIPTION
+Cached answers to "is this an english word?" for postprocessing.py.
+
+Subtitle vocabulary is zipfian, so nearly every dictionary check repeats one a
+    few thousand words back. WordVerdicts answers from, in order:
+    a bounded cache of recent verdicts (per process)
+    a verdicts file, if given: every distinct word of a corpus, checked against
+               enchant once ahead of time, sorted and memory-mapped (so all
+               worker processes share one copy through the page cache)
+    enchant itself
+
+The verdicts file is built with the same dictionary and word splitting as the
+    lookups, so it gives exactly the answers enchant would. Words it doesn't
+    have (e.g. from a different corpus) just fall through to enchant.
+
+=== FORMAT
+    first line    #verdicts [dictionary language]
+    then          word \t Y|N, one per line, sorted bytewise
+
+=== USAGE
+python word_verdicts.py [en file] [verdicts file]   # build
+python postprocessing.py [en file] [ja file] --verdicts [verdicts file] > output
+"""
+import os
+import sys
+import mmap
+import string
+import tempfile
+import collections
+import enchant
+from tqdm import tqdm
+
+
+HEADER = '#verdicts'
+DELETE_PUNCTUATION = string.maketrans('', '')
+
+
+def split_words(l):
+    """ whitespace-seperated chunks of l, with punctuation removed
+    """
+    return l.translate(DELETE_PUNCTUATION, string.punctuation).split(' ')
+
+
+def enchant_check(dictionary, word):
+    try:
+        return bool(dictionary.check(word))
+    except:
+        return False    # e.g. the empty string
+
+
+class VerdictFile():
+    """ binary search over a memory-mapped verdicts file
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.header = f.readline()
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if not self.header.startswith(HEADER):
+            raise ValueError('not a verdicts file: %s' % path)
+        self.lang = self.header.split()[1] if len(self.header.split()) > 1 else None
+        self.start = len(self.header)
+
+
+    def lookup(self, word):
+        """ returns: True / False, or None if word isn't in the file
+        """
+        data = self.data
+        lo, hi = self.start, len(data)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            i = data.rfind('\n', lo, mid)
+            line_start = i + 1 if i >= 0 else lo
+            line_end = data.find('\n', line_start)
+            if line_end < 0:
+                line_end = len(data)
+            key, _, verdict = data[line_start:line_end].rpartition('\t')
+            if key == word:
+                return verdict == 'Y'
+            if key < word:
+                lo = line_end + 1
+            else:
+                hi = line_start
+        return None
+
+
+class WordVerdicts():
+    """ not thread-safe; each worker process has its own
+    """
+    def __init__(self, dictionary, path=None, cache_size=100000):
+        self.dictionary = dictionary
+        self.file = VerdictFile(path) if path else None
+        self.cache_size = cache_size
+        # hits are a plain dict lookup (this runs for every word of the corpus, so
+        #   utils.LRUCache's lock and reordering would cost more than they save).
+        #   evicts oldest-inserted first; with zipfian words, anything common
+        #   that's evicted is back on its next use
+        self.cache = collections.OrderedDict()
+
+
+    def check(self, word):
+        verdict = self.cache.get(word)
+        if verdict is None:
+            if self.file is not None:
+                verdict = self.file.lookup(word)
+            if verdict is None:
+                verdict = enchant_check(self.dictionary, word)
+            self.cache[word] = verdict
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return verdict
+
+
+def build(en_path, out_path, lang='en_US'):
+    """ checks every distinct word of en_path (lowercased, as postprocessing
+        sees them) and writes the verdicts to out_path
+    """
+    vocab = set()
+    for line in tqdm(open(en_path), desc='vocabulary'):
+        for word in split_words(line.lower()):
+            word = word.strip()
+            if '\t' not in word and '\n' not in word:
+                vocab.add(word)
+    dictionary = enchant.Dict(lang)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(out_path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write('%s %s\n' % (HEADER, lang))
+            for word in tqdm(sorted(vocab), desc='verdicts'):
+                f.write('%s\t%s\n' % (word, 'Y' if enchant_check(dictionary, word) else 'N'))
+        os.chmod(tmp, 0644)
+        os.rename(tmp, out_path)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return len(vocab)
+
+
+if __name__ == '__main__':
+    n = build(sys.argv[1], sys.argv[2])
+    print 'WROTE VERDICTS FOR %d WORDS TO %s' % (n, sys.argv[2])
@@ -0,0 +1,75 @@
+"""
+=== DESCRIPTION
+An append-only checkpoint log: one finished key (e.g. an srt path) per line,
+    mirrored in an in-memory set for O(1) lookups. The file format is the same
+    as parser_v4's old donefile, so existing donefiles keep working.
+
+Appends take an exclusive lock and go out as a single write on an O_APPEND
+    descriptor followed by an fsync, so concurrent writers never interleave
+    partial lines, and a key is only on disk once its write has completed.
+
+=== USAGE
+store = CheckpointStore('donefile')
+if srt not in store:
+    ... do the work, write the outputs ...
+    store.add(srt)
+"""
+import os
+import fcntl
+
+
+class CheckpointStore():
+    def __init__(self, path, load=True):
+        """ load=False skips reading the log, for processes that only append
+        """
+        self.path = path
+        self.done = set()
+        self.offset = 0
+        if load:
+            self.refresh()
+
+
+    def refresh(self):
+        """ picks up keys appended (by anyone) since the last refresh
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        end = data.rfind('\n') + 1   # ignore a trailing partial line
+        for line in data[:end].split('\n'):
+            line = line.strip()
+            if line:
+                self.done.add(line)
+        self.offset += end
+
+
+    def add(self, key):
+        self.add_many([key])
+
+
+    def add_many(self, keys):
+        """ durably appends keys to the log
+        """
+        keys = [k for k in keys if k not in self.done]
+        if len(keys) == 0:
+            return
+        data = ''.join(k + '\n' for k in keys)
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            while data:
+                data = data[os.write(fd, data):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)   # closing releases the lock
+        self.done.update(keys)
+
+
+    def __contains__(self, key):
+        return key in self.done
+
+
+    def __len__(self):
+        return len(self.done)
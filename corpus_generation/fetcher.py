@@ -0,0 +1,170 @@
+"""
+=== DESCRIPTION
+A small concurrent fetch engine for the crawler: a pool of worker threads
+    sharing a bounded pool of sessions (browsers or http clients), a per-host
+    rate limit, retries with exponential backoff, and a checkpoint of finished
+    items so an interrupted crawl picks up where it stopped.
+
+Fetching is network-bound, so threads are plenty here (and sessions like a
+    selenium driver can't cross processes anyway).
+
+=== USAGE
+sessions = SessionPool(make_session, size=4, broken=(requests.ConnectionError, requests.Timeout))
+limiter = RateLimiter(per_second=2)
+
+def work(url):
+    limiter.wait(url)
+    with sessions.session() as s:
+        ...
+    return 'success'     # or 'skipped' / 'failure'
+
+outcomes = crawl(urls, work, workers=4, done=CheckpointStore('urls.done'))
+"""
+import time
+import random
+import urlparse
+import threading
+import collections
+import Queue
+from multiprocessing.pool import ThreadPool
+
+
+class RateLimiter():
+    """ spaces out requests to each host to at most per_second
+    """
+    def __init__(self, per_second=1.0):
+        self.interval = 1.0 / per_second if per_second > 0 else 0
+        self.next_slot = {}   # host => earliest time of its next request
+        self.lock = threading.Lock()
+
+
+    def wait(self, url):
+        if not self.interval:
+            return
+        host = urlparse.urlparse(url).netloc
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot.get(host, 0))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class SessionPool():
+    """ up to `size` sessions from factory(), created on demand and reused.
+        a session that raised one of `broken` (transport errors, a dead driver)
+        is closed and replaced, in case it's wedged. other errors (a 404, a
+        page without the expected element) leave the session fine to reuse
+    """
+    def __init__(self, factory, size=4, close=None, broken=(Exception,)):
+        self.factory = factory
+        self.close_session = close
+        self.broken = broken
+        self.idle = Queue.Queue()
+        self.slots = threading.Semaphore(size)
+        self.all = []
+        self.lock = threading.Lock()
+
+
+    def session(self):
+        return Checkout(self)
+
+
+    def acquire(self):
+        self.slots.acquire()
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            pass
+        try:
+            s = self.factory()
+        except:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.all.append(s)
+        return s
+
+
+    def release(self, s, broken=False):
+        if broken:
+            self.discard(s)
+        else:
+            self.idle.put(s)
+        self.slots.release()
+
+
+    def discard(self, s):
+        with self.lock:
+            if s in self.all:
+                self.all.remove(s)
+        if self.close_session is not None:
+            try:
+                self.close_session(s)
+            except:
+                pass
+
+
+    def close(self):
+        with self.lock:
+            sessions = list(self.all)
+        for s in sessions:
+            self.discard(s)
+
+
+class Checkout():
+    def __init__(self, pool):
+        self.pool = pool
+
+
+    def __enter__(self):
+        self.s = self.pool.acquire()
+        return self.s
+
+
+    def __exit__(self, exc_type, exc, tb):
+        self.pool.release(self.s, broken=exc_type is not None and issubclass(exc_type, self.pool.broken))
+
+
+def retry(fn, retries=3, backoff=1.0, exceptions=(Exception,)):
+    """ calls fn() until it doesn't raise, up to retries more times, sleeping
+        backoff * 2^attempt (jittered) in between. the last failure is re-raised
+    """
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except exceptions:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * (2 ** attempt) * (0.5 + random.random()))
+
+
+def rebase(url, base_url):
+    """ points url at base_url's scheme and host (e.g. a local stub server)
+    """
+    if not base_url:
+        return url
+    parts = urlparse.urlparse(url)
+    base = urlparse.urlparse(base_url)
+    return urlparse.urlunparse((base.scheme, base.netloc) + tuple(parts[2:]))
+
+
+def crawl(items, work, workers=4, done=None):
+    """ runs work(item) => outcome for each item not in done, over a pool of
+        threads. items that come back 'success' are added to done (a CheckpointStore)
+
+        returns: Counter of outcomes
+    """
+    todo = [item for item in items if done is None or item not in done]
+    outcomes = collections.Counter()
+    outcomes['already done'] = len(items) - len(todo)
+    pool = ThreadPool(workers)
+    try:
+        for item, outcome in pool.imap_unordered(lambda item: (item, work(item)), todo):
+            outcomes[outcome] += 1
+            if outcome == 'success' and done is not None:
+                done.add(item)
+    finally:
+        pool.close()
+        pool.join()
+    return outcomes
@@ -0,0 +1,218 @@
+"""
+=== DESCRIPTION
+Per-job stage timings and counters for parser_v4, plus opt-in per-worker profiling.
+
+Every process has a current Metrics: code anywhere in the pipeline times a stage
+    or bumps a counter on it, and parser_v4 starts a fresh one for each job and
+    ships it back to the coordinator with the job's stats. The coordinator writes
+    one json line per job and prints a summary at the end.
+
+Stages: load (srt parsing + cleaning), translate, tfidf (vocabularies and
+    vectors), match (scoring + solving), queue (waiting on the writer), write.
+
+Profiling runs per worker, and is dumped after every job to [profile_dir]:
+    cprofile   worker-[pid].prof, for pstats / snakeviz
+    sample     worker-[pid].stacks, stacks sampled every 10ms of cpu time,
+               one "frame;frame;frame count" per line (flamegraph.pl's input).
+               signals only reach the main thread, so with --pipeline this
+               sees scoring but not the translate / en prep threads
+
+=== USAGE
+with metrics.stage('translate'):
+    ...
+metrics.count('candidates_scored', n)
+
+m = metrics.reset()    # start a new job
+m.record()             # => {'seconds': {stage: s}, 'counts': {name: n}}
+"""
+import os
+import json
+import time
+import signal
+import cProfile
+import pstats
+import threading
+import collections
+
+
+class Timer():
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+
+    def __enter__(self):
+        self.start = time.time()
+
+
+    def __exit__(self, *exc):
+        self.metrics.add_time(self.stage, time.time() - self.start)
+
+
+class Metrics():
+    def __init__(self):
+        self.seconds = collections.Counter()
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()   # the pipeline updates from several threads
+
+
+    def timer(self, stage):
+        return Timer(self, stage)
+
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            self.seconds[stage] += seconds
+
+
+    def add(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+
+    def merge(self, record):
+        """ adds in a record() from elsewhere
+        """
+        with self.lock:
+            self.seconds.update(record['seconds'])
+            self.counts.update(record['counts'])
+
+
+    def record(self):
+        with self.lock:
+            return {'seconds': dict(self.seconds), 'counts': dict(self.counts)}
+
+
+# this process's current job
+CURRENT = Metrics()
+
+
+def reset():
+    global CURRENT
+    CURRENT = Metrics()
+    return CURRENT
+
+
+def stage(name):
+    return CURRENT.timer(name)
+
+
+def count(name, n=1):
+    CURRENT.add(name, n)
+
+
+def append_jsonl(path, record):
+    """ appends one json line (a single write, so concurrent appenders don't interleave)
+    """
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def summarize(total, wall_seconds, workers):
+    """ prints where the time went, from the merged Metrics of a run
+    """
+    record = total.record()
+    busy = sum(record['seconds'].values())
+    print 'STAGE TIMES (%.1fs wall, %d workers)' % (wall_seconds, workers)
+    for name, seconds in sorted(record['seconds'].items(), key=lambda x: -x[1]):
+        print '\t %-12s %10.2fs %6.1f%%' % (name, seconds, 100.0 * seconds / max(busy, 1e-9))
+    print 'COUNTERS'
+    for name, n in sorted(record['counts'].items()):
+        print '\t %-24s %d' % (name, n)
+
+
+class Profiler():
+    """ profiles one worker process across all of its jobs
+    """
+    SAMPLE_INTERVAL = 0.01
+
+    def __init__(self, kind, out_dir):
+        self.kind = kind
+        self.out_dir = out_dir
+        if not os.path.isdir(out_dir):
+            try:
+                os.makedirs(out_dir)
+            except OSError:
+                pass   # another worker made it first
+        self.profile = cProfile.Profile() if kind == 'cprofile' else None
+        self.samples = collections.Counter()
+        if kind == 'sample':
+            signal.signal(signal.SIGPROF, self.sample)
+
+
+    def path(self):
+        ext = 'prof' if self.kind == 'cprofile' else 'stacks'
+        return os.path.join(self.out_dir, 'worker-%d.%s' % (os.getpid(), ext))
+
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s:%s:%d' % (os.path.basename(code.co_filename), code.co_name, code.co_firstlineno))
+            frame = frame.f_back
+        self.samples[';'.join(reversed(stack))] += 1
+
+
+    def start(self):
+        if self.kind == 'cprofile':
+            self.profile.enable()
+        else:
+            signal.setitimer(signal.ITIMER_PROF, self.SAMPLE_INTERVAL, self.SAMPLE_INTERVAL)
+
+
+    def stop(self):
+        """ stops sampling and rewrites this worker's profile so far
+        """
+        if self.kind == 'cprofile':
+            self.profile.disable()
+            self.profile.dump_stats(self.path())
+        else:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            with open(self.path(), 'w') as f:
+                for stack, n in self.samples.items():
+                    f.write('%s %d\n' % (stack, n))
+
+
+def clear_profiles(out_dir):
+    """ removes worker profiles left over from an earlier run
+    """
+    if os.path.isdir(out_dir):
+        for f in os.listdir(out_dir):
+            if f.startswith('worker-') and (f.endswith('.prof') or f.endswith('.stacks')):
+                os.remove(os.path.join(out_dir, f))
+
+
+def summarize_profiles(kind, out_dir, top=25):
+    """ merges every worker's profile in out_dir and prints the hot spots
+    """
+    if not os.path.isdir(out_dir):
+        return
+    if kind == 'cprofile':
+        paths = [os.path.join(out_dir, f) for f in os.listdir(out_dir) if f.endswith('.prof')]
+        if len(paths) == 0:
+            return
+        print 'PROFILE (%d workers, by cumulative time)' % len(paths)
+        pstats.Stats(*paths).sort_stats('cumulative').print_stats(top)
+        return
+
+    own = collections.Counter()    # samples where the frame was on top
+    inside = collections.Counter() # samples where the frame was anywhere on the stack
+    total = 0
+    for f in os.listdir(out_dir):
+        if not f.endswith('.stacks'):
+            continue
+        for line in open(os.path.join(out_dir, f)):
+            stack, n = line.rsplit(' ', 1)
+            n = int(n)
+            frames = stack.split(';')
+            own[frames[-1]] += n
+            for frame in set(frames):
+                inside[frame] += n
+            total += n
+    if total == 0:
+        return
+    print 'SAMPLED PROFILE (%d samples)' % total
+    print '\t %8s %8s  frame' % ('self', 'total')
+    for frame, n in own.most_common(top):
+        print '\t %7.1f%% %7.1f%%  %s' % (100.0 * n / total, 100.0 * inside[frame] / total, frame)
@@ -2,8 +2,28 @@
 === DESCRIPTION
 This program takes a directory of crawled subs and produces aligned phrase pairs.
 
+ja files are grouped into jobs by title (so each worker parses and vectorizes a
+    title's en files once), and handed out largest-first to a pool of workers.
+    the coordinator owns the set of finished files and reports per-worker throughput.
+
+workers stream their aligned pairs through a queue to a single writer process,
+    which appends them to line-aligned [en_out] / [ja_out] / trans outputs
+    (optionally sharded and gzipped, see result_writer.py). if the writer dies
+    (disk full, a bad path...), the coordinator stops the workers and exits
+    with its error.
+
+finished ja files are checkpointed in [donefile] (see checkpoint.py), each one
+    only after its outputs are written, so a crash never drops work. files whose
+    extraction raised (e.g. the translator went down) aren't checkpointed, so the
+    next run retries them.
+
 === USAGE                                                                                                                            
-python parser.py [data_loc] [en_out] [ja_out] -t [num_threads (OPTIONAL)]                                                
+python parser.py [data_loc] [en_out] [ja_out] [donefile] -t [num_threads (OPTIONAL)]
+    optional: --trans_worker [cmd] --trans_jobs [n] --trans_timeout [s] --trans_cache [sqlite file]
+              --solver [v3|dp] --time_band [ms]
+              --trans_out [file] --shard_size [lines] --compress
+              --pipeline --pipeline_threads [n] --index_dir [dir]
+              --metrics [jsonl file] --profile [cprofile|sample] --profile_dir [dir]
                                                                                                                                      
 === PRECONDITION
 data_loc is structured as follows:                                                                                                     
@@ -16,13 +36,18 @@ root/   (this is your arg)
     ... 
 """
 # coding: utf-8                                                                                                                      
-from joblib import Parallel, delayed
+from multiprocessing import Pool, Process
+from multiprocessing.pool import ThreadPool
+import multiprocessing
+import Queue
+import threading
 import pysrt
 import sys
 import numpy as np
 import string
 import os
 import datetime
+import time
 import collections
 from tqdm import tqdm
 import re
@@ -31,7 +56,14 @@ import argparse # option parsing
 from guessit import guessit
 from difflib import SequenceMatcher
 from subfile_aligner import Aligner
-import random
+from translator import get_translator
+from checkpoint import CheckpointStore
+from subtitle_index import SubtitleIndex
+from utils import LRUCache, CLEAN_CACHE
+from tf_idf import IDF_CACHE
+from srt_reader import PARSED
+import metrics
+from result_writer import write_results
 
 
 def process_command_line():
@@ -41,36 +73,95 @@ def process_command_line():
 
     # positional args                                                                                                                
     parser.add_argument('data_loc', metavar='data_loc', type=str, help='crawl output directory')
-    parser.add_argument('en_out', metavar='en_out', type=str, help='en output dir')
-    parser.add_argument('ja_out', metavar='ja_out', type=str, help='ja output dir')
+    parser.add_argument('en_out', metavar='en_out', type=str, help='en output file')
+    parser.add_argument('ja_out', metavar='ja_out', type=str, help='ja output file')
     parser.add_argument('donefile', metavar='donefile', type=str, help='file to track finished srts with')
 
     # optional args                                                                                                                  
     parser.add_argument('-t', '--threads', dest='num_threads', type=int, default=1, help='num threads to parse with')
+    parser.add_argument('--trans_out', dest='trans_out', type=str, default=None,
+                        help='similarity|translation output file. default: [en_out].trans')
+    parser.add_argument('--shard_size', dest='shard_size', type=int, default=0,
+                        help='start a new output shard every this many lines (0: no sharding)')
+    parser.add_argument('--compress', dest='compress', action='store_true', help='gzip the outputs')
+    parser.add_argument('--trans_worker', dest='trans_worker', type=str, default=None,
+                        help='long-lived translation worker command (see translator.py). default: one ./trans per caption')
+    parser.add_argument('--trans_jobs', dest='trans_jobs', type=int, default=1,
+                        help='./trans processes each worker runs at once, without --trans_worker')
+    parser.add_argument('--trans_timeout', dest='trans_timeout', type=int, default=60,
+                        help='seconds to wait on --trans_worker for each translation before restarting it')
+    parser.add_argument('--trans_cache', dest='trans_cache', type=str, default=None,
+                        help='sqlite file to cache translations in (see translation_cache.py)')
+    parser.add_argument('--trans_cache_size', dest='trans_cache_size', type=int, default=1000000,
+                        help='max number of cached translations')
+    parser.add_argument('--solver', dest='solver', type=str, default='v3', choices=['v3', 'dp'],
+                        help='alignment solver: v3 (windowed argmax) or dp (monotonic, timestamp-banded)')
+    parser.add_argument('--index_dir', dest='index_dir', type=str, default=None,
+                        help='directory to keep preprocessed srts in (.jescidx, see subtitle_index.py), '
+                             'so re-runs skip parsing and translation')
+    parser.add_argument('--pipeline', dest='pipeline', action='store_true',
+                        help='overlap translation, en parsing and scoring within each worker')
+    parser.add_argument('--pipeline_threads', dest='pipeline_threads', type=int, default=2,
+                        help='en prep threads per worker in --pipeline mode')
+    parser.add_argument('--metrics', dest='metrics', type=str, default=None,
+                        help='append per-job stage timings and counters here, as json lines')
+    parser.add_argument('--profile', dest='profile', type=str, default=None, choices=['cprofile', 'sample'],
+                        help='profile every worker (see metrics.py)')
+    parser.add_argument('--profile_dir', dest='profile_dir', type=str, default='profiles',
+                        help='where worker profiles go')
+    parser.add_argument('--time_band', dest='time_band', type=int, default=None,
+                        help='only score en captions that overlap a ja caption in time, +/- this many ms')
 
     args = parser.parse_args()
     return args
 
 
 
-def should_align(ja_f, en_f):
-    """ some title-based heuristics on whether two filepaths are a match
+# guessit is slow, so every filename is only parsed once per process
+GUESSES = LRUCache(maxsize=100000)
+SIMILARITIES = LRUCache(maxsize=100000)
+TITLE_INDEXES = LRUCache(maxsize=64)
+
+
+def guess(f):
+    """ memoized guessit(f)
+    """
+    info = GUESSES.get(f)
+    if info is None:
+        info = guessit(f)
+        GUESSES.put(f, info)
+    return info
+
+
+def hashable(x):
+    return tuple(x) if isinstance(x, list) else x
+
+
+def similarity(a, b):
+    """ memoized SequenceMatcher ratio, 0 if either side is missing
     """
-    def similarity(a, b):
-        if not a or not b or len(a) == 0 or len(b) == 0:
-            return 0
+    if not a or not b or len(a) == 0 or len(b) == 0:
+        return 0
+    key = (hashable(a), hashable(b))
+    try:
+        ratio = SIMILARITIES.get(key)
+    except TypeError:   # unhashable guessit value
         return SequenceMatcher(None, a, b).ratio()
+    if ratio is None:
+        ratio = SequenceMatcher(None, a, b).ratio()
+        SIMILARITIES.put(key, ratio)
+    return ratio
 
-    # for testing
-    def report(b):
-        print b
-        print ja_f
-        print en_f
 
-    ja = guessit(ja_f)
-    en = guessit(en_f)
+def should_align(ja_f, en_f):
+    """ some title-based heuristics on whether two filepaths are a match
+    """
+    return should_align_info(guess(ja_f), guess(en_f))
 
 
+def should_align_info(ja, en):
+    """ should_align, on already-parsed guessit metadata
+    """
     if similarity(ja.get('title'), en.get('title')) < 0.5:
         return False
 
@@ -85,7 +176,45 @@ def should_align(ja_f, en_f):
             return True
 
     return False
-        
+
+
+class TitleIndex():
+    """ the en srts of one title, bucketed by guessit type and episode, so a ja srt
+        is only checked against the few en srts that could possibly match it
+    """
+    def __init__(self, en_title_root):
+        self.movies = []
+        self.episodes = collections.defaultdict(list)   # episode => [(position, en srt, info)]
+        self.episode_titles = []   # episodes with an episode_title, which can match any episode
+        for position, en_subfile in enumerate(os.listdir(en_title_root)):
+            info = guess(en_subfile)
+            entry = (position, os.path.join(en_title_root, en_subfile), info)
+            if info.get('type') == 'movie':
+                self.movies.append(entry)
+            elif info.get('type') == 'episode':
+                self.episodes[hashable(info.get('episode'))].append(entry)
+                if info.get('episode_title'):
+                    self.episode_titles.append(entry)
+
+
+    def candidates(self, ja):
+        if ja.get('type') == 'movie':
+            return self.movies
+        if ja.get('type') == 'episode':
+            out = self.episodes.get(hashable(ja.get('episode')), [])
+            if ja.get('episode_title'):
+                out = out + self.episode_titles
+            return out
+        return []
+
+
+    def matches(self, ja_subfile):
+        """ returns: [en srts that should be aligned with ja_subfile], in directory order
+        """
+        ja = guess(ja_subfile)
+        found = set((position, en_srt) for (position, en_srt, en) in self.candidates(ja)
+                    if should_align_info(ja, en))
+        return [en_srt for (position, en_srt) in sorted(found)]
 
 
 def get_file_alignments(ja_subfile, en_title_root):
@@ -93,122 +222,367 @@ def get_file_alignments(ja_subfile, en_title_root):
     
         returns: [en matches]
     """
+    index = TITLE_INDEXES.get(en_title_root)
+    if index is None:
+        index = TitleIndex(en_title_root)
+        TITLE_INDEXES.put(en_title_root, index)
+    return index.matches(ja_subfile)
+
+
+def subtitle_index(args):
+    """ the --index_dir cache, if any. ja artifacts hold translations,
+        so they're tagged with the translator that made them
+    """
+    if not args.index_dir:
+        return None
+    return SubtitleIndex(args.index_dir, tag=args.trans_worker or './trans')
+
+
+def build_aligner(ja_srt, title_root, args, en_cache=None):
+    """ finds a ja srt's matching en srts and translates it
+
+        returns: [en matches], Aligner
+    """
+    print '\t GETTING FILE ALIGNMENTS FOR ', ja_srt
+    en_srts = get_file_alignments(ja_srt, os.path.join(title_root, 'en'))
+    print '\t ALIGNED EN FILES FOR ', ja_srt
+    for en_srt in en_srts:
+        print '\t\t ', en_srt
+
+    print '\t BUILDING SUBTITLE ALIGNER FOR...', ja_srt
+    translator = get_translator(args.trans_worker, args.trans_cache, args.trans_cache_size,
+                                args.trans_jobs, args.trans_timeout)
+    a = Aligner(ja_srt, translator, en_cache, subtitle_index(args))
+    print '\t SUBTITLE ALIGNER BUILT...', ja_srt
+    return en_srts, a
+
+
+def harvest(ja_srt, a, en_srts, args):
+    """ scores a built aligner against each of its en srts
+
+        returns: [ (en, ja, sim, trans) ]
+    """
+    print '\t HARVESTING SUBS FROM', ja_srt
     alignments = []
-    for en_subfile in os.listdir(en_title_root):
-        if should_align(ja_subfile, en_subfile):
-            alignments.append(os.path.join(en_title_root, en_subfile))
+    for en_subfile in en_srts:
+        print '\t\t MATCHING WITH ', en_subfile
+        a.load(en_subfile)
+        solve = getattr(a, 'solve_' + args.solver)
+        with metrics.stage('match'):
+            for pair in (solve(band=args.time_band) if args.time_band is not None else solve()):
+                alignments.append(pair)
+        metrics.count('candidates_scored', a.candidates_scored)
+        metrics.count('refit_scored', a.refit_scored)
+    metrics.count('pairs', len(alignments))
+
+    if len(alignments) == 0:
+        print 'NO ALIGNMENTS FOR ', ja_srt, en_srts
     return alignments
 
 
-def get_dones(donefile):
-    if not os.path.exists(donefile):
-        return []
-    dones = open(donefile).readlines()
-    dones = [x.strip() for x in dones]
-    return dones
+def log_exception(ja_srt, e):
+    print 'EXCEPTION  ON ', ja_srt
+    metrics.count('files_failed')
+    with open('EXCEPTIONS', 'a') as f:
+        f.write(str(e))
+
+
+def extract_checked(ja_srt, title_root, args, en_cache=None):
+    """ extract_subs, telling failures apart from files with no alignments
+
+        returns: ([ (en, ja, sim, trans) ], whether it finished without an exception)
+    """
+    try:
+        en_srts, a = build_aligner(ja_srt, title_root, args, en_cache)
+        return harvest(ja_srt, a, en_srts, args), True
+    except Exception as e:
+        log_exception(ja_srt, e)
+        return [], False
+
+
+def extract_subs(ja_srt, title_root, args, en_cache=None):
+    """ parse and align subs for a ja srt and its matching en srts
 
+        returns: [ (en, ja, sim, trans) ]
+    """
+    return extract_checked(ja_srt, title_root, args, en_cache)[0]
 
-def update_dones(donefile, srt):
-    with open(donefile, 'a') as dones:
-        dones.write(srt + '\n')
 
+def extract_pipelined(title_root, ja_srts, args, en_cache, depth=2):
+    """ extract_subs over a batch of ja srts, as a pipeline: a translate thread builds
+        aligners for the upcoming ja files (at most `depth` ahead, through a bounded
+        queue) and hands their en files to a pool of prep threads, while this thread
+        scores. translation waits on the translator's process, so it overlaps with
+        everything else; en parsing and scoring share the GIL, but numpy / scipy
+        release it for the heavy lifting
 
-def extract_subs(ja_srt, title_root, donefile):
-    """ parse and align, and write subs for a pair of srt files
+        yields: (ja srt, [ (en, ja, sim, trans) ], whether it finished without an exception)
     """
+    built = Queue.Queue(maxsize=depth)
+    en_pool = ThreadPool(args.pipeline_threads)
+    en_jobs = {}   # en srt => AsyncResult of Aligner.prepare_en
+    index = subtitle_index(args)
+    stop = threading.Event()
+
+    def translate_stage():
+        for ja_srt in ja_srts:
+            if stop.is_set():
+                break
+            try:
+                en_srts, a = build_aligner(ja_srt, title_root, args, en_cache)
+                for en_srt in en_srts:
+                    if en_srt not in en_cache and en_srt not in en_jobs:
+                        en_jobs[en_srt] = en_pool.apply_async(Aligner.prepare_en, (en_srt, index))
+                built.put((ja_srt, en_srts, a, None))
+            except Exception as e:
+                built.put((ja_srt, [], None, e))
+        built.put(None)
+
+    translator = threading.Thread(target=translate_stage)
+    translator.daemon = True
+    translator.start()
     try:
-        dones = get_dones(donefile)
-        if ja_srt in dones:
-            print 'ALREADY DONE, SHORT CIRCUTING ', ja_srt
+        while True:
+            item = built.get()
+            if item is None:
+                break
+            ja_srt, en_srts, a, error = item
+            alignments = []
+            ok = False
+            try:
+                if error is not None:
+                    raise error
+                for en_srt in en_srts:
+                    if en_srt not in en_cache:
+                        en_cache[en_srt] = en_jobs[en_srt].get()
+                alignments = harvest(ja_srt, a, en_srts, args)
+                ok = True
+            except Exception as e:
+                log_exception(ja_srt, e)
+            yield ja_srt, alignments, ok
+    finally:
+        # unblock and drain the translate thread if we're bailing out early
+        stop.set()
+        while translator.is_alive():
+            try:
+                built.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        en_pool.close()
+        en_pool.join()
+
+
+# the writer's queue, and an event the coordinator sets if the writer dies,
+#   handed to each pool worker by init_worker
+RESULTS = None
+WRITER_GONE = None
+# seconds between checks that the writer is still alive, while waiting on it
+WRITER_CHECK = 1.0
+# this worker's profiler, with --profile
+PROFILER = None
+
+# per-process caches whose hit rates go into each job's counters
+CACHES = {'clean': CLEAN_CACHE, 'guessit': GUESSES, 'idf': IDF_CACHE, 'srt': PARSED}
+
+
+def init_worker(results, writer_gone, profile=None, profile_dir=None):
+    global RESULTS, WRITER_GONE, PROFILER
+    RESULTS = results
+    WRITER_GONE = writer_gone
+    if profile:
+        PROFILER = metrics.Profiler(profile, profile_dir)
+
+
+def put_result(msg):
+    """ hands msg to the writer. RESULTS is bounded, so if the writer has died
+        this would otherwise block forever
+    """
+    while True:
+        try:
+            RESULTS.put(msg, timeout=WRITER_CHECK)
             return
-        update_dones(donefile, ja_srt)
-
-        print '\t GETTING FILE ALIGNMENTS FOR ', ja_srt
-        en_srts = get_file_alignments(ja_srt, os.path.join(title_root, 'en'))
-        print '\t ALIGNED EN FILES FOR ', ja_srt
-        for en_srt in en_srts:
-            print '\t\t ', en_srt
-
-        print '\t BUILDING SUBTITLE ALIGNER FOR...', ja_srt
-        a = Aligner(ja_srt)
-        print '\t SUBTITLE ALIGNER BUILT...', ja_srt
-
-        print '\t HARVESTING SUBS FROM', ja_srt
-        alignments = []
-        for en_subfile in en_srts:
-            print '\t\t MATCHING WITH ', en_subfile
-            a.load(en_subfile)
-            for pair in a.solve_v3():
-                alignments.append(pair)
+        except Queue.Full:
+            if WRITER_GONE.is_set():
+                raise IOError('the writer process died')
 
-        if len(alignments) == 0:
-            print 'NO ALIGNMENTS FOR ', ja_srt, en_srts
-            return
-        en = ''
-        ja = ''
-        t = ''
-        for en_s, ja_s, sim, trans in alignments:
-            t += str(sim) + "|" + trans + '\n' 
-            en += en_s + '\n'
-            ja += ja_s + '\n'
-        title = title_root.split('/')[1]
-        print '\t WRITING RESULTS TO ', title + '_en_subs'
-        with open(title + '_en_subs', 'a') as f:
-            f.write(en.encode('utf8'))
-        print '\t WRITING RESULTS TO ', title + '_trans_subs'
-        with open(title + '_trans_subs', 'a') as f:
-            f.write(t.encode('utf8'))
-        print '\t WRITING RESULTS TO ', title + '_ja_subs'
-        with open(title + '_ja_subs', 'a') as f:
-            f.write(ja.encode('utf8'))
-    except Exception as e:
-        print 'EXCEPTION  ON ', ja_srt
-        with open('EXCEPTIONS', 'a') as f:
-            f.write(str(e))
 
+def extract_title(job):
+    """ worker: aligns a batch of ja srts from one title, and streams each one's
+        pairs to the writer. the title's en files are parsed and vectorized
+        once, then shared by every ja file in the batch. with --pipeline,
+        translation and en prep run ahead of scoring (see extract_pipelined)
 
-def generate_subfiles(root_dir):
-    """ spits out ja files and aligned en files
+        returns: stats for the coordinator
+    """
+    title_root, ja_srts, size, args = job
+    start = time.time()
+    m = metrics.reset()
+    before = dict((name, (c.hits, c.misses)) for name, c in CACHES.items())
+    if PROFILER is not None:
+        PROFILER.start()
+
+    en_cache = {}
+    pairs = 0
+    done = []
+    if args.pipeline:
+        results = extract_pipelined(title_root, ja_srts, args, en_cache)
+    else:
+        results = ((ja_srt,) + extract_checked(ja_srt, title_root, args, en_cache) for ja_srt in ja_srts)
+    for ja_srt, alignments, ok in results:
+        # the writer only checkpoints files that finished, so failures are retried next run
+        with m.timer('queue'):
+            put_result((ja_srt, alignments, ok))
+        pairs += len(alignments)
+        if ok:
+            done.append(ja_srt)
+
+    if PROFILER is not None:
+        PROFILER.stop()
+    for name, c in CACHES.items():
+        m.add('%s_cache_hits' % name, c.hits - before[name][0])
+        m.add('%s_cache_misses' % name, c.misses - before[name][1])
+    m.add('files', len(ja_srts))
+    return {'pid': os.getpid(), 'title': title_root, 'done': done, 'files': ja_srts,
+            'bytes': size, 'pairs': pairs, 'seconds': time.time() - start, 'metrics': m.record()}
+
+
+def dir_size(d):
+    if not os.path.isdir(d):
+        return 0
+    return sum(os.path.getsize(os.path.join(d, f)) for f in os.listdir(d))
+
+
+def generate_jobs(root_dir, dones, max_files=25):
+    """ groups each title's unfinished ja files into jobs of at most max_files,
+        sorted by estimated size (ja bytes + the title's en bytes), largest first
+
+        returns: [ (title root, [ja srts], estimated size) ]
     """
-    out = []
+    jobs = []
     for title_dir in os.listdir(root_dir):
-        for ja_subfile in os.listdir(os.path.join(root_dir, title_dir, 'ja')):
-            out.append((os.path.join(root_dir, title_dir, 'ja', ja_subfile), \
-                        os.path.join(root_dir, title_dir)))
-    random.shuffle(out)
-    for (ja, title) in out:
-        yield ja, title
+        title_root = os.path.join(root_dir, title_dir)
+        ja_dir = os.path.join(title_root, 'ja')
+        ja_srts = [os.path.join(ja_dir, f) for f in sorted(os.listdir(ja_dir))]
+        ja_srts = [f for f in ja_srts if f not in dones]
+        en_size = dir_size(os.path.join(title_root, 'en'))
+        for i in range(0, len(ja_srts), max_files):
+            batch = ja_srts[i:i + max_files]
+            size = sum(os.path.getsize(f) for f in batch) + en_size
+            jobs.append((title_root, batch, size))
+    return sorted(jobs, key=lambda job: job[2], reverse=True)
+
+
+def report_throughput(workers):
+    """ prints per-worker throughput
+    """
+    print 'WORKER THROUGHPUT'
+    for pid, stats in sorted(workers.items()):
+        seconds = max(stats['seconds'], 1e-6)
+        print '\t worker %d: %d jobs, %d files, %.1f MB, %d pairs in %.1fs (%.2f files/s, %.3f MB/s)' % (
+            pid, stats['jobs'], stats['files'], stats['bytes'] / 1e6, stats['pairs'], stats['seconds'],
+            stats['files'] / seconds, stats['bytes'] / 1e6 / seconds)
 
 
-def main(data_loc, en_out, ja_out, num_threads, donefile):
-    root = data_loc
-    os.system("find %s -type f -name '*.DS_Store' -delete" % root)
-
-    Parallel(n_jobs=num_threads)(delayed(extract_subs)(ja, title, donefile) \
-                                     for (ja, title) in generate_subfiles(data_loc))
+def writer_died(writer, writer_stats):
+    """ raises with the writer's error (from its stats record, if it got one out)
+    """
+    try:
+        error = writer_stats.get(timeout=WRITER_CHECK).get('error')
+    except Queue.Empty:
+        error = None
+    raise RuntimeError('the writer process died (exit code %s)%s' % (
+        writer.exitcode, ':\n' + error if error else ''))
 
-    # Parallel makes its own namespace, so i couldn't modify a shared
-    # dictionary or anything. had to split and join.
-    print 'JOINING RESULTS...'
-    split_order = []
-    for f in os.listdir('.'):
-        if '_en_subs' in f:
-            split_order.append(f.split('_')[0])   # TODO - BETER SPLITTER
 
-    en_cat = 'cat ' + ' '.join('%s_en_subs' % title for title in split_order) + ' > %s' % en_out
-    ja_cat = 'cat ' + ' '.join('%s_ja_subs' % title for title in split_order) + ' > %s' % ja_out
+def wait_for_writer(writer, writer_stats, call, *args):
+    """ call(*args, timeout=...) on one of the writer's queues, until it goes through
+    """
+    while writer.is_alive():
+        try:
+            return call(*args, timeout=WRITER_CHECK)
+        except (Queue.Full, Queue.Empty):
+            pass
+    # one last try, in case it went through just as the writer exited
+    try:
+        return call(*args, timeout=WRITER_CHECK)
+    except (Queue.Full, Queue.Empty):
+        writer_died(writer, writer_stats)
 
-    os.system(ja_cat)
 
-    os.system(en_cat)
+def main(args):
+    start = time.time()
+    root = args.data_loc
+    os.system("find %s -type f -name '*.DS_Store' -delete" % root)
 
-    print 'NOT CLEANING UP...'
-#    os.system('rm *_subs')
+    # the done set lives here, in the coordinator. workers only append to the donefile
+    dones = CheckpointStore(args.donefile)
+    jobs = generate_jobs(root, dones)
+    print 'SCHEDULING %d JA FILES IN %d JOBS (%d ALREADY DONE)' % (
+        sum(len(job[1]) for job in jobs), len(jobs), len(dones))
+
+    # one writer process owns the outputs (and checkpoints what it's written)
+    results = multiprocessing.Queue(maxsize=4 * args.num_threads)
+    writer_stats = multiprocessing.Queue()
+    writer_gone = multiprocessing.Event()
+    writer = Process(target=write_results, args=(
+        results, args.en_out, args.ja_out, args.trans_out or args.en_out + '.trans',
+        args.donefile, args.shard_size, args.compress, writer_stats))
+    writer.start()
+
+    # idle workers pull the next-largest job off the shared queue
+    workers = collections.defaultdict(collections.Counter)
+    total = metrics.Metrics()
+    if args.profile:
+        metrics.clear_profiles(args.profile_dir)
+    pool = Pool(args.num_threads, initializer=init_worker,
+                initargs=(results, writer_gone, args.profile, args.profile_dir))
+    finished = pool.imap_unordered(extract_title, [job + (args,) for job in jobs])
+    while True:
+        try:
+            result = finished.next(timeout=WRITER_CHECK)
+        except StopIteration:
+            break
+        except multiprocessing.TimeoutError:
+            if not writer.is_alive():
+                # nothing will drain the results queue now, so workers can't finish
+                writer_gone.set()
+                pool.terminate()
+                writer_died(writer, writer_stats)
+            continue
+        dones.done.update(result['done'])
+        stats = workers[result['pid']]
+        stats['jobs'] += 1
+        stats['files'] += len(result['files'])
+        for k in ['bytes', 'pairs', 'seconds']:
+            stats[k] += result[k]
+        total.merge(result['metrics'])
+        if args.metrics:
+            record = dict((k, result[k]) for k in ['pid', 'title', 'bytes', 'pairs'])
+            record.update(result['metrics'], kind='job', files=result['files'], done=result['done'],
+                          wall_seconds=result['seconds'], time=time.time())
+            metrics.append_jsonl(args.metrics, record)
+    pool.close()
+    pool.join()
+    wait_for_writer(writer, writer_stats, results.put, None)
+    # before join: the writer can't exit with this unread
+    written = wait_for_writer(writer, writer_stats, writer_stats.get)
+    writer.join()
+    if 'error' in written or writer.exitcode != 0:
+        raise RuntimeError('the writer process failed (exit code %s)%s' % (
+            writer.exitcode, ':\n' + written['error'] if 'error' in written else ''))
+    total.merge(written)
+    if args.metrics:
+        written.update(kind='writer', time=time.time())
+        metrics.append_jsonl(args.metrics, written)
+
+    report_throughput(workers)
+    metrics.summarize(total, time.time() - start, args.num_threads)
+    if args.profile:
+        metrics.summarize_profiles(args.profile, args.profile_dir)
 
     print 'DONE'
 
                                                                                                                                      
 if __name__ == '__main__':
     args = process_command_line()
-    main(args.data_loc, args.en_out, args.ja_out, args.num_threads, args.donefile)
-
+    main(args)
@@ -0,0 +1,125 @@
+"""
+=== DESCRIPTION
+Streams aligned caption pairs into line-aligned en / ja / trans outputs.
+    parser_v4 runs one writer process; workers put their results on a queue,
+    and the writer appends them and then checkpoints the ja file they came from.
+
+With a shard_size, outputs roll over to a new shard every shard_size lines
+    (en_out.00000, en_out.00001, ...), and all three outputs always roll over
+    together. A re-run starts a fresh shard instead of touching old ones.
+
+=== USAGE
+w = ShardedWriter('en.txt', 'ja.txt', 'trans.txt', shard_size=1000000, compress=True)
+w.write([(en, ja, sim, trans), ...])
+w.close()
+"""
+import os
+import gzip
+import traceback
+import metrics
+from checkpoint import CheckpointStore
+
+
+class ShardedWriter():
+    def __init__(self, en_out, ja_out, trans_out, shard_size=0, compress=False):
+        self.bases = [en_out, ja_out, trans_out]
+        self.shard_size = shard_size
+        self.compress = compress
+        self.files = None
+        self.lines = 0   # lines in the current shard
+        self.shard = self.first_free_shard() if shard_size else None
+
+
+    def path(self, base, shard):
+        if shard is not None:
+            base = '%s.%05d' % (base, shard)
+        return base + '.gz' if self.compress else base
+
+
+    def first_free_shard(self):
+        shard = 0
+        while any(os.path.exists(self.path(base, shard)) for base in self.bases):
+            shard += 1
+        return shard
+
+
+    def open(self):
+        paths = [self.path(base, self.shard) for base in self.bases]
+        if self.compress:
+            self.files = [gzip.open(p, 'ab') for p in paths]
+        else:
+            self.files = [open(p, 'ab') for p in paths]
+
+
+    def close(self):
+        if self.files is not None:
+            for f in self.files:
+                f.close()
+            self.files = None
+
+
+    def write(self, pairs):
+        """ appends [(en, ja, sim, trans)], one line each to the en / ja / trans outputs
+        """
+        for en, ja, sim, trans in pairs:
+            if self.shard_size and self.lines >= self.shard_size:
+                self.close()
+                self.shard += 1
+                self.lines = 0
+            if self.files is None:
+                self.open()
+            lines = [en, ja, str(sim) + '|' + (trans or '')]
+            for f, line in zip(self.files, lines):
+                f.write(line.replace('\n', ' ').encode('utf8') + '\n')
+            self.lines += 1
+
+
+    def flush(self):
+        """ gets everything written so far onto disk, so it's safe to checkpoint
+        """
+        if self.files is not None:
+            for f in self.files:
+                f.flush()
+                os.fsync(f.fileno())
+
+
+def write_results(queue, en_out, ja_out, trans_out, donefile, shard_size=0, compress=False, stats=None):
+    """ the writer process: drains (ja srt, [pairs], ok) off the queue until it gets None.
+        a ja srt is only checkpointed once its pairs are on disk, and only if its
+        extraction finished (ok); failed files are left for the next run to retry.
+        if given a stats queue, puts its metrics record there before exiting, with
+        the traceback under 'error' if it died
+    """
+    m = metrics.reset()
+    error = None
+    writer = None
+    try:
+        writer = ShardedWriter(en_out, ja_out, trans_out, shard_size, compress)
+        checkpoints = CheckpointStore(donefile, load=False)
+        while True:
+            msg = queue.get()
+            if msg is None:
+                break
+            ja_srt, pairs, ok = msg
+            with m.timer('write'):
+                writer.write(pairs)
+                writer.flush()
+                if ok:
+                    checkpoints.add(ja_srt)
+            m.add('files_written' if ok else 'files_not_checkpointed')
+            m.add('pairs_written', len(pairs))
+        writer.close()
+    except Exception:
+        error = traceback.format_exc()
+        if writer is not None:
+            try:
+                writer.close()
+            except Exception:
+                pass
+        raise
+    finally:
+        if stats is not None:
+            record = m.record()
+            if error is not None:
+                record['error'] = error
+            stats.put(record)
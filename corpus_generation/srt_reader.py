@@ -0,0 +1,205 @@
+"""
+=== DESCRIPTION
+A lightweight .srt reader. Parses a subtitle file into columns instead of
+    pysrt's per-caption objects: start / end times (ms) as int64 arrays, and
+    every caption's text in one unicode buffer, sliced by an offsets array.
+
+Parsing follows pysrt.open (BOM sniffing, utf8 default, strict decoding,
+    blank-line separated blocks, optional index lines, lenient timestamps,
+    malformed blocks skipped), so captions and timings come out the same.
+
+load_srt() keeps recently parsed files in a per-process cache, keyed by
+    path and invalidated when the file's mtime or size changes. This lets the
+    aligner and tf-idf share a single parse of each en file.
+
+=== USAGE
+srt = load_srt('movie.srt')
+len(srt), srt.starts, srt.ends    # np.int64 arrays, in ms
+srt.text(i)                       # caption i
+srt.texts()                       # [captions]
+
+python srt_reader.py [srt files]  # benchmark against pysrt
+"""
+import os
+import re
+import sys
+import time
+import codecs
+import numpy as np
+from utils import LRUCache
+
+
+BOMS = ((codecs.BOM_UTF32_LE, 'utf_32_le'),
+        (codecs.BOM_UTF32_BE, 'utf_32_be'),
+        (codecs.BOM_UTF16_LE, 'utf_16_le'),
+        (codecs.BOM_UTF16_BE, 'utf_16_be'),
+        (codecs.BOM_UTF8, 'utf_8'))
+TIMESTAMP_SEPARATOR = u'-->'
+TIME_SEP = re.compile(r'\:|\.|\,')
+INTEGER = re.compile(r'^(\d+)')
+# the common case, parsed in one match: HH:MM:SS,mmm --> HH:MM:SS,mmm[ position]
+TIMESTAMPS = re.compile(r'^[ \t]*(\d+)[:.,](\d+)[:.,](\d+)[:.,](\d+)[ \t]*-->'
+                        r'[ \t]*(\d+)[:.,](\d+)[:.,](\d+)[:.,](\d+)(?: |$)')
+
+
+class SrtFile():
+    """ columnar captions: starts / ends (ms) and text offsets into one buffer
+    """
+    def __init__(self, path, starts, ends, buf, offsets):
+        self.path = path
+        self.starts = starts
+        self.ends = ends
+        self.buf = buf
+        self.offsets = offsets
+
+
+    def __len__(self):
+        return len(self.starts)
+
+
+    def text(self, i):
+        return self.buf[self.offsets[i]:self.offsets[i + 1]]
+
+
+    def texts(self):
+        o = self.offsets.tolist()
+        return [self.buf[o[i]:o[i + 1]] for i in range(len(self))]
+
+
+def decode(data):
+    """ decodes a subfile's bytes like pysrt: a BOM picks the codec (and is
+        dropped), otherwise utf8. raises UnicodeDecodeError on bad input
+    """
+    for bom, encoding in BOMS:
+        if data.startswith(bom):
+            return data[len(bom):].decode(encoding)
+    return data.decode('utf_8')
+
+
+def parse_int(digits):
+    try:
+        return int(digits)
+    except ValueError:
+        match = INTEGER.match(digits)
+        if match:
+            return int(match.group())
+        return 0
+
+
+def parse_time(s):
+    """ 'HH:MM:SS,mmm' => ms. returns None for malformed timestamps
+    """
+    if not s:
+        return 0
+    items = TIME_SEP.split(s)
+    if len(items) != 4:
+        return None
+    h, m, sec, ms = [parse_int(i) for i in items]
+    return h * 3600000 + m * 60000 + sec * 1000 + ms
+
+
+def parse_block(lines):
+    """ one caption: [index line], timestamp line, text lines
+
+        returns: (start, end, text) or None if the block is malformed
+    """
+    if len(lines) < 2:
+        return None
+    lines = [l.rstrip() for l in lines]
+    if TIMESTAMP_SEPARATOR not in lines[0]:
+        lines.pop(0)
+    match = TIMESTAMPS.match(lines[0])
+    if match and lines[0].count(TIMESTAMP_SEPARATOR) == 1:
+        h, m, sec, ms, h2, m2, sec2, ms2 = map(int, match.groups())
+        return (h * 3600000 + m * 60000 + sec * 1000 + ms,
+                h2 * 3600000 + m2 * 60000 + sec2 * 1000 + ms2,
+                u'\n'.join(lines[1:]))
+    timestamps = lines[0].split(TIMESTAMP_SEPARATOR)
+    if len(timestamps) != 2:
+        return None
+    start, end = timestamps
+    end = end.lstrip().split(' ', 1)[0]
+    start, end = parse_time(start.strip()), parse_time(end.strip())
+    if start is None or end is None:
+        return None
+    return start, end, u'\n'.join(lines[1:])
+
+
+def parse_srt_string(source, path=None):
+    """ parses decoded subfile contents
+
+        returns: SrtFile
+    """
+    starts, ends, texts = [], [], []
+    block = []
+    for line in source.splitlines(True) + [u'\n']:
+        if line.strip():
+            block.append(line)
+        elif block:
+            caption = parse_block(block)
+            block = []
+            if caption is not None:
+                starts.append(caption[0])
+                ends.append(caption[1])
+                texts.append(caption[2])
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum([len(t) for t in texts], out=offsets[1:])
+    return SrtFile(path, np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64),
+                   u''.join(texts), offsets)
+
+
+def parse_srt(path):
+    """ reads and parses a subfile (uncached)
+
+        returns: SrtFile
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    return parse_srt_string(decode(data), path)
+
+
+# path => (mtime, size, SrtFile)
+PARSED = LRUCache(maxsize=256)
+
+
+def load_srt(path):
+    """ parse_srt, through the per-process cache
+
+        returns: SrtFile
+    """
+    st = os.stat(path)
+    cached = PARSED.get(path)
+    if cached is not None and cached[:2] == (st.st_mtime, st.st_size):
+        return cached[2]
+    srt = parse_srt(path)
+    PARSED.put(path, (st.st_mtime, st.st_size, srt))
+    return srt
+
+
+def benchmark(paths, repeats=3):
+    """ times parse_srt against pysrt.open on each file, and checks they agree
+    """
+    import pysrt
+    ours, theirs, captions, mismatches = 0.0, 0.0, 0, 0
+    for path in paths:
+        for _ in range(repeats):
+            start = time.time()
+            srt = parse_srt(path)
+            ours += time.time() - start
+            start = time.time()
+            subs = pysrt.open(path)
+            theirs += time.time() - start
+        captions += len(srt) * repeats
+        if ([s.text for s in subs] != srt.texts() or
+                [s.start.ordinal for s in subs] != srt.starts.tolist() or
+                [s.end.ordinal for s in subs] != srt.ends.tolist()):
+            mismatches += 1
+            print 'MISMATCH ', path
+    print '%d files, %d captions parsed' % (len(paths), captions)
+    print '\t srt_reader: %.3fs (%.0f captions/s)' % (ours, captions / max(ours, 1e-9))
+    print '\t pysrt:      %.3fs (%.0f captions/s)' % (theirs, captions / max(theirs, 1e-9))
+    print '\t speedup: %.1fx, %d mismatched files' % (theirs / max(ours, 1e-9), mismatches)
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1:])
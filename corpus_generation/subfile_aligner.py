@@ -6,29 +6,94 @@ The Aligner class can align japanese/english subtitle files, and
 
 === USAGE
 
-a = Aligner(ja_srt_file)
+a = Aligner(ja_srt_file, translator=None)   # see translator.py, defaults to ./trans
+                                            # en_cache={} shares parsed en files between aligners
 a.load(en_srt_file)
 
 for en_caption, ja_caption, similarity_score, approx_translation in a.solve_v3():
     # do what you want
+
+a.solve_dp() is a drop-in alternative to a.solve_v3(): a monotonic (no crossing,
+    no repeats) alignment over the same similarity scores, banded by timestamps
+
+a = Aligner(ja_srt_file, index=SubtitleIndex(dir))  # loads / saves preprocessed files
+                                                    # (see subtitle_index.py)
+
+a.solve_v3(band=2000) only considers en captions that overlap each ja caption in
+    time (+/- band ms), after fitting a linear offset/drift between the two files
 """
 # -*- coding: utf-8 -*-
 import string
-import pysrt
 import re
 from tqdm import tqdm
 import collections
 import os
 from tf_idf import TF_IDF
 import numpy as np
-from utils import clean_caption
+from utils import clean_caption, clean_caption_cached
+from translator import CommandTranslator
+from srt_reader import load_srt, SrtFile
+from subtitle_index import pack_strings, unpack_strings
+from scipy import sparse
+import metrics
+
+
+class IntervalIndex():
+    """ index over a set of [start, end] intervals (caption timings, in ms)
+    """
+    def __init__(self, starts, ends):
+        self.order = np.argsort(starts, kind='mergesort')
+        self.starts = np.asarray(starts)[self.order]
+        self.ends = np.asarray(ends)[self.order]
+        # prefix max of the ends is sorted, so it can be binary searched too
+        self.max_ends = np.maximum.accumulate(self.ends) if len(self.ends) > 0 else self.ends
+
+
+    def overlapping(self, lo, hi):
+        """ intervals overlapping [lo[k], hi[k]] for every query k
+
+            returns: [ np.array of interval ids ]
+        """
+        first = np.searchsorted(self.max_ends, lo, side='left')
+        last = np.searchsorted(self.starts, hi, side='right')
+        out = []
+        for k in range(len(first)):
+            ids = np.arange(first[k], max(first[k], last[k]))
+            out.append(self.order[ids[self.ends[ids] >= lo[k]]])
+        return out
+
+
+def pack_srt(srt):
+    """ SrtFile => {name: np.array}, for a SubtitleIndex
+    """
+    buf, _ = pack_strings([srt.buf])
+    return {'starts': srt.starts, 'ends': srt.ends, 'text': buf, 'text_offsets': srt.offsets}
+
+
+def unpack_srt(arrays, path):
+    """ inverse of pack_srt
+    """
+    buf = arrays['text'].tostring().decode('utf8')
+    return SrtFile(path, arrays['starts'], arrays['ends'], buf, arrays['text_offsets'])
+
 
 class Aligner():
-    def __init__(self, ja_file):
+    def __init__(self, ja_file, translator=None, en_cache=None, index=None):
+        """ index: a SubtitleIndex to load / save preprocessed ja and en files through
+        """
         self.ja_file = ja_file
-        self.ja = pysrt.open(ja_file)
-        self.ja_start = self.first_content_caption(self.ja)
+        self.translator = translator or CommandTranslator()
+        self.en_cache = en_cache if en_cache is not None else {}
+        self.index = index
+        saved = index.load(ja_file, 'ja') if index is not None else None
+        if saved is not None:
+            self.unpack_ja(saved)
+            return
+        with metrics.stage('load'):
+            self.ja = load_srt(ja_file)
+            self.ja_start = self.first_content_caption(self.ja)
         self.ja_translations = self.build_ja_translations()
+        self.trans_tokens = None   # stemmed translations, built on first load()
 
 
     def build_ja_translations(self, min_trans=500):
@@ -37,31 +102,191 @@ class Aligner():
 
             returns: [ (translation, caption) ]
         """
-        out = []
-        for x in range(self.ja_start, min(min_trans, len(self.ja))):
-            caption = clean_caption(self.ja[x].text)
-            if len(caption) > 0:
-                out.append(( self.translate(caption), caption) )
-        return out
+        captions = []
+        self.ja_indices = []   # where each translated caption sits in self.ja
+        with metrics.stage('load'):
+            for x in range(self.ja_start, min(min_trans, len(self.ja))):
+                caption = clean_caption(self.ja.text(x))
+                if len(caption) > 0:
+                    captions.append(caption)
+                    self.ja_indices.append(x)
+            self.ja_times = self.ja.starts[self.ja_indices]
+            self.ja_end_times = self.ja.ends[self.ja_indices]
+        metrics.count('ja_captions', len(self.ja))
+        metrics.count('captions_translated', len(captions))
+        with metrics.stage('translate'):
+            return zip(self.translator.translate_many(captions), captions)
 
 
     def load(self, en_file):
         """ load an en subfile (.srt) into the aligner
         """
         self.en_file = en_file
-        self.en = pysrt.open(en_file)
-        self.en_start = self.first_content_caption(self.en)
-        # build tf-idf vectors for each caption
-        self.tf_idf = TF_IDF(en_file)        
+        if en_file not in self.en_cache:
+            self.en_cache[en_file] = self.prepare_en(en_file, self.index)
+        vars(self).update(self.en_cache[en_file])
+        self.time_map = None   # (scale, offset), fit lazily
+        self.candidates_scored = 0   # for the band the solver matched with
+        self.refit_scored = 0        # for the wider band fit_time_mapping refits on
+
+        # translations only need stemming once, but have to be
+        #   re-vectorized against each en file's vocabulary
+        if self.trans_tokens is None:
+            with metrics.stage('tfidf'):
+                self.trans_tokens = [self.tf_idf.prep_caption(trans) for (trans, _) in self.ja_translations]
+            # a failed translation ('') would be stuck in the artifact for good,
+            #   so only save once every caption translated, and retry next run otherwise
+            failed = sum(1 for (trans, _) in self.ja_translations if trans == '')
+            if self.index is not None and failed == 0:
+                try:
+                    self.index.save(self.ja_file, 'ja', self.pack_ja(), {'ja_start': self.ja_start})
+                except (IOError, OSError):
+                    pass
+        with metrics.stage('tfidf'):
+            self.trans_known = np.array([toks is not None for toks in self.trans_tokens], dtype=bool)
+            self.trans_vecs = self.tf_idf.build_tfidf_matrix([toks or [] for toks in self.trans_tokens])
+
+
+    def pack_ja(self):
+        """ the ja side's preprocessed state (timings, cleaned captions, translations,
+            stemmed translation tokens) as {name: np.array}. changes here (or in
+            pack_en) need a subtitle_index.FORMAT_VERSION bump
+        """
+        arrays = pack_srt(self.ja)
+        arrays['ja_indices'] = np.array(self.ja_indices, dtype=np.int64)
+        translations = [trans for (trans, _) in self.ja_translations]
+        arrays['captions'], arrays['caption_offsets'] = pack_strings([ja for (_, ja) in self.ja_translations])
+        arrays['trans'], arrays['trans_offsets'] = pack_strings([trans or u'' for trans in translations])
+        arrays['trans_none'] = np.array([trans is None for trans in translations], dtype=bool)
+
+        # tokens as ids into a table of the distinct tokens
+        table = {}
+        ids = []
+        token_offsets = [0]
+        for toks in self.trans_tokens:
+            for tok in toks or []:
+                ids.append(table.setdefault(tok, len(table)))
+            token_offsets.append(len(ids))
+        arrays['tokens'], arrays['tokens_offsets'] = pack_strings(sorted(table, key=table.get))
+        arrays['token_ids'] = np.array(ids, dtype=np.int32)
+        arrays['token_offsets'] = np.array(token_offsets, dtype=np.int64)
+        arrays['tokens_none'] = np.array([toks is None for toks in self.trans_tokens], dtype=bool)
+        return arrays
+
+
+    def unpack_ja(self, saved):
+        """ restores the state pack_ja() saved
+        """
+        arrays = saved['arrays']
+        self.ja = unpack_srt(arrays, self.ja_file)
+        self.ja_start = saved['meta']['ja_start']
+        self.ja_indices = arrays['ja_indices'].tolist()
+        self.ja_times = self.ja.starts[self.ja_indices]
+        self.ja_end_times = self.ja.ends[self.ja_indices]
+        captions = unpack_strings(arrays['captions'], arrays['caption_offsets'])
+        translations = unpack_strings(arrays['trans'], arrays['trans_offsets'])
+        translations = [None if none else trans for (trans, none) in zip(translations, arrays['trans_none'])]
+        self.ja_translations = zip(translations, captions)
+
+        table = unpack_strings(arrays['tokens'], arrays['tokens_offsets'])
+        ids = arrays['token_ids'].tolist()
+        o = arrays['token_offsets'].tolist()
+        self.trans_tokens = [None if none else [table[t] for t in ids[o[i]:o[i + 1]]]
+                             for i, none in enumerate(arrays['tokens_none'])]
+
+
+    @staticmethod
+    def pack_en(state):
+        """ a prepare_en() result as {name: np.array}
+        """
+        arrays = pack_srt(state['en'])
+        arrays['captions'], arrays['caption_offsets'] = pack_strings(state['en_captions'])
+        tokens, arrays['idf'] = state['tf_idf'].vocab_table()
+        arrays['vocab'], arrays['vocab_offsets'] = pack_strings(tokens)
+        arrays['vecs_data'] = state['en_vecs'].data
+        arrays['vecs_indices'] = state['en_vecs'].indices
+        arrays['vecs_indptr'] = state['en_vecs'].indptr
+        arrays['known'] = state['en_known']
+        return arrays
+
+
+    @staticmethod
+    def unpack_en(saved, en_file):
+        """ inverse of pack_en
+        """
+        arrays = saved['arrays']
+        en = unpack_srt(arrays, en_file)
+        tokens = unpack_strings(arrays['vocab'], arrays['vocab_offsets'])
+        tf_idf = TF_IDF(en_file, vocab=zip(tokens, arrays['idf'].tolist()))
+        # scipy may canonicalize in place, so the sparse parts get copied out of the mapping
+        en_vecs = sparse.csr_matrix(
+            (np.array(arrays['vecs_data']), np.array(arrays['vecs_indices']), np.array(arrays['vecs_indptr'])),
+            shape=(len(en), len(tokens)))
+        return {
+            'en': en,
+            'en_start': saved['meta']['en_start'],
+            'en_times': en.starts,
+            'en_end_times': en.ends,
+            'en_index': IntervalIndex(en.starts, en.ends),
+            'tf_idf': tf_idf,
+            'en_captions': unpack_strings(arrays['captions'], arrays['caption_offsets']),
+            'en_vecs': en_vecs,
+            'en_known': arrays['known'],
+        }
+
+
+    @staticmethod
+    def prepare_en(en_file, index=None):
+        """ parses, cleans and vectorizes an en subfile. none of this depends on
+            the ja file, so it can be shared through an en_cache (or done ahead of time),
+            and saved to / loaded from a SubtitleIndex
+
+            returns: {attribute: value}
+        """
+        saved = index.load(en_file, 'en') if index is not None else None
+        if saved is not None:
+            with metrics.stage('load'):
+                return Aligner.unpack_en(saved, en_file)
+
+        with metrics.stage('load'):
+            en = load_srt(en_file)
+            en_times = en.starts
+            en_end_times = en.ends
+            en_captions = [clean_caption_cached(text) for text in en.texts()]
+        metrics.count('en_captions', len(en))
 
+        with metrics.stage('tfidf'):
+            # build tf-idf vectors for each caption (from the same parse)
+            tf_idf = TF_IDF(en_file)
+            # vectorize every en caption exactly once
+            en_vecs, en_known = tf_idf.ref_matrix(en_captions)
+        state = {
+            'en': en,
+            'en_start': Aligner.first_content_caption(en),
+            'en_times': en_times,
+            'en_end_times': en_end_times,
+            'en_index': IntervalIndex(en_times, en_end_times),
+            'tf_idf': tf_idf,
+            'en_captions': en_captions,
+            'en_vecs': en_vecs,
+            'en_known': en_known,
+        }
+        if index is not None:
+            try:
+                index.save(en_file, 'en', Aligner.pack_en(state), {'en_start': state['en_start']})
+            except (IOError, OSError):
+                pass
+        return state
 
-    def first_content_caption(self, subfile):
+
+    @staticmethod
+    def first_content_caption(subfile):
         """ finds the first caption with a real caption.
             this is typically the first caption at a "real" time (i.e. not at 2:00)
         """
-        for i, sub in enumerate(subfile):
-            if sub.start.milliseconds != 0:
-                return i
+        found = np.flatnonzero(subfile.starts % 1000 != 0)
+        if len(found) > 0:
+            return int(found[0])
 
 
     def translate(self, caption):
@@ -69,56 +294,231 @@ class Aligner():
          
             returns: translation (str)
         """        
-        try:
-            # delete whitespace from ja
-            ja = caption.replace(' ', '').encode('utf8')
-            ja = ja.replace('\xe3\x80\x80', '')
-            ja = ja.strip()
-            if len(ja) == 0:
-                return None
-            # get trans
-            cmd = "./trans ja: " + ja
-            result = os.popen(cmd).read().split('\n')[-2].split(',')[0]
-
-            # parse trans
-            result = ''.join([char for char in result if char in string.printable])
-            result = result[7:-4].lower()
-            return result
-
-        except: 
-            return ''
-
-
-    def get_caption_matches(self):
-        """ match up en and ja srt files
+        return self.translator.translate(caption)
+
+
+    def score_band(self, lo, hi):
+        """ scores ja translation i against en captions lo[i] <= j < hi[i].
+            wide bands come out of one sparse (ja x en) product; narrow bands
+            only score the in-band pairs
+
+            returns: dense (len(lo) x len(self.en)) np.array, -inf outside the band
+        """
+        n = len(lo)
+        m = len(self.en)
+        lo = np.asarray(lo, dtype=np.int64)
+        hi = np.maximum(lo, np.asarray(hi, dtype=np.int64))
+        widths = hi - lo
+        self.candidates_scored += int(widths.sum())
+
+        if widths.sum() * 4 >= n * m:
+            sims = self.tf_idf.similarity_matrix(self.en_vecs, self.trans_vecs[:n])
+            cols = np.arange(m)
+            band = (cols >= lo[:, None]) & (cols < hi[:, None])
+            return np.where(band, sims, -np.inf)
+
+        out = np.empty((n, m))
+        out.fill(-np.inf)
+        if widths.sum() == 0:
+            return out
+        rows = np.repeat(np.arange(n), widths)
+        cols = np.concatenate([np.arange(l, h) for (l, h) in zip(lo, hi)])
+        trans_m = self.trans_vecs[rows]
+        en_m = self.en_vecs[cols]
+        dots = np.asarray(trans_m.multiply(en_m).sum(axis=1)).ravel()
+        mags = self.tf_idf.magnitudes(trans_m) * self.tf_idf.magnitudes(en_m)
+        sims = np.zeros(len(dots))
+        ok = (dots != 0) & (mags != 0)
+        sims[ok] = dots[ok] / mags[ok]
+        out[rows, cols] = sims
+        return out
+
+
+    def get_caption_matches(self, band=None):
+        """ match up en and ja srt files. with a band (ms), the candidates for
+            each ja caption are the en captions that overlap it in time (see time_bands),
+            instead of a positional window
             returns: a list of (en caption, ja caption) tuples
 
             TODO - use trans as reference for in tf-idf matching because
                    those are your pivots anyway....
         """
+        if band is not None:
+            if len(self.ja_translations) == 0 or len(self.en) == 0:
+                return []
+            lo, hi = self.time_bands(band)
+            sims = self.score_band(lo, hi)
+            best = len(self.en) - 1 - np.argmax(sims[:, ::-1], axis=1)
+            return [self.match(i, best[i], sims) for i in range(len(lo)) if lo[i] < hi[i]]
+
         j = self.ja_start
         e = self.en_start
         delta = (abs((len(self.ja) - j) - (len(self.en) - e)))
-        matches = []
-        for i, (trans, ja_sub) in enumerate(self.ja_translations):
-            if e+i > len(self.en):
-                break
-            candidates = []
-            for j in range(max(0, e+i-10), min(len(self.en), e+i+delta)):
-                en_sub = clean_caption(self.en[j].text)
-                sim, en_vec, trans_vec =  self.tf_idf.similarity(en_sub, trans)
-                subs = (en_sub, ja_sub)
-                candidates.append( (sim, j, subs, trans, en_vec, trans_vec) )
-            candidates = sorted(candidates)[::-1]
-            if len(candidates) > 0:
-                matches.append(candidates[0])
-        return matches
-
-
-    def solve_v3(self):
-        """ main alignment logic. for each ja caption, take its approximate translation
-            and look around for nearby en captions with high tf-idf similarity
-            
+
+        # for each ja caption, its window of candidate en captions
+        n = max(0, min(len(self.ja_translations), len(self.en) - e + 1))
+        lo = [max(0, e+i-10) for i in range(n)]
+        hi = [min(len(self.en), e+i+delta) for i in range(n)]
+        if n == 0 or len(self.en) == 0:
+            return []
+        sims = self.score_band(lo, hi)
+
+        # best candidate per row, breaking ties towards the later en caption
+        best = len(self.en) - 1 - np.argmax(sims[:, ::-1], axis=1)
+
+        return [self.match(i, best[i], sims) for i in range(n) if lo[i] < hi[i]]
+
+
+    def match(self, i, j, sims):
+        """ builds the match tuple for ja translation i and en caption j
+
+            returns: (sim, j, (en caption, ja caption), translation, en vec, trans vec)
+        """
+        trans, ja_sub = self.ja_translations[i]
+        en_vec, trans_vec = None, None
+        if self.en_known[j] and self.trans_known[i]:
+            en_vec, trans_vec = self.en_vecs[j], self.trans_vecs[i]
+        subs = (self.en_captions[j], ja_sub)
+        return (float(sims[i, j]), j, subs, trans, en_vec, trans_vec)
+
+
+    def fit_time_mapping(self):
+        """ fits a linear map from ja to en time, en ~= scale * ja + offset.
+            starts from lining up the ends of the two files, then refits on confident
+            matches (least squares, outliers trimmed). scales outside 0.9-1.1 are
+            treated as different cuts rather than frame-rate drift, and ignored
+
+            returns: (scale, offset)
+        """
+        if self.time_map is not None:
+            return self.time_map
+
+        ja_first = self.ja.starts[self.ja_start]
+        ja_last = self.ja.ends.max()
+        en_first = self.en_times[self.en_start]
+        en_last = self.en_end_times.max()
+        scale = 1.0
+        if ja_last > ja_first:
+            scale = (en_last - en_first) * 1.0 / (ja_last - ja_first)
+        if not 0.9 <= scale <= 1.1:
+            scale = 1.0
+        offset = en_first - scale * ja_first
+        self.time_map = (scale, offset)
+
+        # refit on the matches we're sure about
+        lo, hi = self.time_bands(30000)
+        scored = self.candidates_scored
+        sims = self.score_band(lo, hi)
+        self.refit_scored += self.candidates_scored - scored
+        self.candidates_scored = scored
+        best = np.argmax(sims, axis=1)
+        best_sims = sims[np.arange(len(best)), best]
+        sure = best_sims > max(0.5, np.mean(best_sims[best_sims > -np.inf]))
+        if sure.sum() >= 10:
+            x = self.ja_times[sure].astype(np.float64)
+            y = self.en_times[best[sure]].astype(np.float64)
+            for _ in range(2):
+                fit = np.polyfit(x, y, 1)
+                resid = np.abs(y - np.polyval(fit, x))
+                keep = resid <= 3 * np.median(resid) + 500
+                if keep.sum() < 10:
+                    break
+                x, y = x[keep], y[keep]
+            if 0.9 <= fit[0] <= 1.1:
+                self.time_map = (fit[0], fit[1])
+        return self.time_map
+
+
+    def time_bands(self, band=15000):
+        """ for each ja translation, the en captions that overlap it in time (+/- band ms),
+            once ja times are mapped onto en times (see fit_time_mapping)
+
+            returns: lo, hi (np.arrays), candidates for row i are lo[i] <= j < hi[i]
+        """
+        scale, offset = self.fit_time_mapping()
+        t_start = scale * self.ja_times + offset - band
+        t_end = scale * self.ja_end_times + offset + band
+        lo = np.zeros(len(t_start), dtype=np.int64)
+        hi = np.zeros(len(t_start), dtype=np.int64)
+        for i, ids in enumerate(self.en_index.overlapping(t_start, t_end)):
+            if len(ids) > 0:
+                lo[i], hi[i] = ids.min(), ids.max() + 1
+            elif i > 0:
+                lo[i] = hi[i] = hi[i - 1]
+        return lo, hi
+
+
+    def dp_alignment(self, sims, lo, hi):
+        """ best monotonic alignment of rows onto columns of sims: each ja row and en
+            column is used at most once, matches never cross, and skipping is free.
+            f[j] is the best total similarity using the rows so far and columns < j.
+            only f[lo[i]..hi[i]] can change on row i, so each row costs O(band)
+
+            returns: [ (row, col) ] in order
+        """
+        n, m = sims.shape
+        hi = np.maximum.accumulate(np.asarray(hi))   # keeps everything right of a band flat
+        f = np.zeros(m + 1)
+        segments = []
+        carry = 0.0
+        filled = 0
+        for i in range(n):
+            l, h = lo[i], hi[i]
+            if h > filled:   # columns no band has reached yet are worth the best score so far
+                f[filled + 1:h + 1] = carry
+                filled = h
+            if l < h:
+                take = f[l:h] + sims[i, l:h]
+                cur = np.maximum(f[l + 1:h + 1], take)
+                f[l + 1:h + 1] = np.maximum.accumulate(np.maximum(cur, f[l]))
+            segments.append(f[l:h + 1].copy())
+            carry = f[h]
+
+        def value(i, j):
+            while i >= 0:
+                j = min(j, hi[i])
+                if j >= lo[i]:
+                    return segments[i][j - lo[i]]
+                i -= 1
+            return 0.0
+
+        pairs = []
+        i, j = n - 1, filled
+        while i >= 0 and j > 0:
+            j = min(j, hi[i])
+            if j <= lo[i]:
+                i -= 1
+                continue
+            v = segments[i][j - lo[i]]
+            if v == segments[i][j - 1 - lo[i]]:
+                j -= 1
+            elif v == value(i - 1, j):
+                i -= 1
+            else:
+                pairs.append((i, j - 1))
+                i -= 1
+                j -= 1
+        return pairs[::-1]
+
+
+    def solve_dp(self, band=5000):
+        """ alternative to solve_v3: a banded, monotonic alignment of the ja translations
+            onto the en captions that maximizes total tf-idf similarity. candidates are
+            restricted to en captions that overlap each ja caption in time (+/- band ms)
+
+            yields: (en, ja) caption pairs
+        """
+        if len(self.ja_translations) == 0 or len(self.en) == 0:
+            return []
+        lo, hi = self.time_bands(band)
+        sims = self.score_band(lo, hi)
+        matches = [self.match(i, j, sims) for (i, j) in self.dp_alignment(sims, lo, hi)]
+        return self.filter_matches(matches)
+
+
+    def filter_matches(self, matches):
+        """ keeps the matches with high similarity and a reasonable en/ja length ratio
+
             yields: (en, ja) caption pairs
         """
         def get_ratio_cutoff(matches):
@@ -133,8 +533,6 @@ class Aligner():
             sim_std = np.std(sims)
             return sim_mean + (0.50 * sim_std)
 
-        matches = self.get_caption_matches()
-
         ratio_cutoff = get_ratio_cutoff(matches)
         sim_cutoff = get_sim_cutoff(matches)
 
@@ -149,3 +547,11 @@ class Aligner():
                 yield en, ja, sim, trans
 
 
+    def solve_v3(self, band=None):
+        """ main alignment logic. for each ja caption, take its approximate translation
+            and look around for nearby en captions with high tf-idf similarity.
+            with a band (ms), "nearby" means overlapping in time instead of position
+            
+            yields: (en, ja) caption pairs
+        """
+        return self.filter_matches(self.get_caption_matches(band))
@@ -22,7 +22,20 @@ root/   (this is your [base dir] argument)
 
 === USAGE
 python crawler.py [url file] [base dir]
+    optional: -t [threads] --mode [http|browser] --browser_fallback --rate [requests/sec per host] --retries [n]
+              --convert_jobs [processes]
+              --state [finished urls file, default: [url file].done] --base_url [e.g. http://localhost:8000]
 
+urls finished in an earlier run (listed in the state file) are skipped, so an
+    interrupted crawl can just be restarted. --base_url sends every request to
+    another host instead of subscene.com, e.g. a local stub server.
+
+By default download links are scraped from the page's html and fetched over
+    pooled keep-alive connections. --mode browser (or --browser_fallback, for
+    pages the scrape fails on) uses headless chrome instead, and needs selenium.
+
+Downloads are unpacked and converted to srt in memory, by a pool of processes
+    (see subtitle_formats.py); only the resulting .srt files are written.
 
 
 
@@ -30,96 +43,174 @@ python crawler.py [url file] [base dir]
 # coding: utf-8
 
 import sys
-from selenium import webdriver
 import os
 import uuid
-import magic
-from pyunpack import Archive
-from ffmpy import FFmpeg
 import re
-import shutil
-from joblib import Parallel, delayed
+import urlparse
+import HTMLParser
+import requests
+import argparse
+import threading
+import collections
+import multiprocessing
+from multiprocessing import Pool
 from tqdm import tqdm
-
-def file_length(f):
-    """ gets the length of a file
+from checkpoint import CheckpointStore
+from fetcher import RateLimiter, SessionPool, retry, rebase, crawl
+from subtitle_formats import convert_download
+try:
+    from selenium.common.exceptions import WebDriverException
+except ImportError:
+    WebDriverException = None   # browser mode needs selenium anyway
+
+
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/70.0 Safari/537.36'
+
+# errors that mean the session itself is broken, so its pool replaces it
+HTTP_ERRORS = (requests.ConnectionError, requests.Timeout)
+BROWSER_ERRORS = (WebDriverException,) if WebDriverException is not None else ()
+
+
+def process_command_line():
+    parser = argparse.ArgumentParser(description='usage')
+    parser.add_argument('urls', metavar='urls', type=str, help='file with one subtitle url per line')
+    parser.add_argument('base_dir', metavar='base_dir', type=str, help='where to download subtitles to')
+    parser.add_argument('-t', '--threads', dest='threads', type=int, default=4, help='concurrent downloads')
+    parser.add_argument('--mode', dest='mode', choices=['http', 'browser'], default='http',
+                        help='find download links by parsing the page (http), or in headless chrome (browser)')
+    parser.add_argument('--browser_fallback', dest='browser_fallback', action='store_true', default=False,
+                        help='in http mode, retry pages without a download link in headless chrome')
+    parser.add_argument('--rate', dest='rate', type=float, default=2.0,
+                        help='max requests per second to any one host (0 for no limit)')
+    parser.add_argument('--retries', dest='retries', type=int, default=2,
+                        help='retries per url, with exponential backoff')
+    parser.add_argument('--backoff', dest='backoff', type=float, default=2.0,
+                        help='seconds before the first retry (doubling after)')
+    parser.add_argument('--convert_jobs', dest='convert_jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='processes for unpacking and converting downloads to srt')
+    parser.add_argument('--state', dest='state', type=str, default=None,
+                        help='finished urls are logged here (default: [urls].done)')
+    parser.add_argument('--base_url', dest='base_url', type=str, default=None,
+                        help='send requests here instead of https://subscene.com')
+    return parser.parse_args()
+
+
+DL_BUTTON = re.compile(r"""<a\b[^>]*\bid=["']downloadButton["'][^>]*>""", re.I)
+HREF = re.compile(r"""\bhref=["']([^"']+)["']""", re.I)
+
+def find_download_link(html, page_url):
+    """ the (absolute) href of the page's downloadButton, or None
     """
-    return int(os.popen('wc -l %s' % f).read().strip().split()[0])
+    button = DL_BUTTON.search(html)
+    if not button:
+        return None
+    href = HREF.search(button.group(0))
+    if not href:
+        return None
+    return urlparse.urljoin(page_url, HTMLParser.HTMLParser().unescape(href.group(1)))
+
+
+def make_http_session():
+    session = requests.Session()
+    # one keep-alive connection per host is all a worker needs
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=1))
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=1))
+    session.headers['User-Agent'] = USER_AGENT
+    return session
+
 
+def make_driver():
+    # only needed for --mode browser / --browser_fallback
+    from selenium import webdriver
+    driver = webdriver.Chrome()
+    driver.set_page_load_timeout(10)   # 10 second limit 
+    return driver
 
-def download_subfile(url, name, dest):
-    """ download a subscene file at url "url" to 
-        the location specified by "dest"
+
+class Downloader():
+    """ fetches subtitle pages and their downloads, either by parsing the page's
+        html (mode 'http'), or in a headless browser (mode 'browser'). http mode
+        can fall back to the browser for pages it can't find a download link in
     """
-    def get_dl_button(url):
-        try:
+    def __init__(self, limiter, size=4, mode='http', browser_fallback=False, timeout=10):
+        self.limiter = limiter
+        self.mode = mode
+        self.browser_fallback = browser_fallback
+        self.timeout = timeout
+        # sessions are only created when first used, so no browser starts unless it's needed
+        self.http = SessionPool(make_http_session, size=size, close=lambda session: session.close(),
+                                broken=HTTP_ERRORS)
+        self.browsers = SessionPool(make_driver, size=size, close=lambda driver: driver.quit(),
+                                    broken=BROWSER_ERRORS)
+
+
+    def link_from_http(self, url):
+        self.limiter.wait(url)
+        with self.http.session() as session:
+            response = session.get(url, timeout=self.timeout)
+            response.raise_for_status()
+            return find_download_link(response.text, response.url)
+
+
+    def link_from_browser(self, url):
+        self.limiter.wait(url)
+        with self.browsers.session() as driver:
             driver.get(url)
-            return driver.find_element_by_id('downloadButton')
-        except:
-            print 'ERROR: cant get dl button ', url
-            return False
-            
-    if not os.path.exists(dest):
-        os.makedirs(dest)
-
-    # download file
-    elem = get_dl_button(url)
-    if not elem:
-        elem = get_dl_button(url)
-    if not elem:
-        print 'ERROR: couldnt get dl button x2', url
-        return None
-            
-    dl_link = elem.get_attribute('href')
-    dl_id = str(uuid.uuid4())
-    target = os.path.join(dest, name + '-' + dl_id)
-    os.system('wget -nc -P %s %s -O %s' % (dest, dl_link, target))
+            # find_element_by_id would raise a WebDriverException, and discard a working driver
+            buttons = driver.find_elements_by_id('downloadButton')
+            return buttons[0].get_attribute('href') if buttons else None
 
-    return target
 
+    def download_link(self, url):
+        link = None
+        if self.mode == 'http':
+            link = self.link_from_http(url)
+        if link is None and (self.mode == 'browser' or self.browser_fallback):
+            link = self.link_from_browser(url)
+        if link is None:
+            raise IOError('no download button on %s' % url)
+        return link
 
-def convert_all_to_srt(dir):
-    """ converts all the files in a dir to srt format
-    """
-    def convert_to_srt(target, dest):
-        ff = FFmpeg(
-            inputs={target: None},
-            outputs={dest: None})
-        ff.run()
 
-    for f in os.listdir(dir):
-        try:
-            f = os.path.join(dir, f)
-            if '.srt' not in f:
-                convert_to_srt(f, f + '.srt')
-        except:
-            print 'ERROR: CONVERSION FAILURE ON', f
+    def fetch(self, link):
+        """ returns: the body of link (subtitle downloads are small, so it's kept in memory)
+        """
+        self.limiter.wait(link)
+        with self.http.session() as session:
+            response = session.get(link, timeout=self.timeout)
+            response.raise_for_status()
+            return response.content
 
 
-def extract_archive(target, dest):
-    """ tries to extract an archive
-    """
-    try:
-        Archive(target).extractall(dest)
-    except:
-        pass
+    def close(self):
+        self.http.close()
+        self.browsers.close()
+
 
-def rm_exclude(dir, suffix):
-    os.system("find %s -type f ! -name '*%s' -delete" % (dir, suffix))
+def download_subfile(url, downloader):
+    """ download a subscene file at url "url"
+
+        returns: its contents
+    """
+    dl_link = downloader.download_link(url)
+    return downloader.fetch(dl_link)
 
 
-def dl_and_convert(dest, url, title):
+def dl_and_convert(dest, url, title, downloader, converters, retries=2, backoff=2.0):
     """ downloads a file from url "url" into destination "dest",
             and then converts it to srt format
     """
-    dlded_filepath = download_subfile(url, title, dest)
-    if dlded_filepath:
-        output = extract_archive(dlded_filepath, dest)
-        convert_all_to_srt(dest)
-        rm_exclude(dest, '.srt')
-        return True
-    else:
+    try:
+        data = retry(lambda: download_subfile(url, downloader), retries, backoff)
+    except Exception as e:
+        print 'ERROR: couldnt download ', url, e
         return False
+    # unpacking and converting is cpu work, so it happens in a process pool
+    name = title + '-' + str(uuid.uuid4())
+    written = converters.apply(convert_download, (data, dest, name))
+    if len(written) == 0:
+        print 'WARNING: no subtitles in download from ', url
+    return True
 
 
 def should_skip(base_dir, title, language):
@@ -143,39 +234,64 @@ def should_skip(base_dir, title, language):
         return False
 
 
-url_base = lambda url: re.findall("https://subscene.com/subtitles/(.*)/[japanese|english]", url)[0]
-base_dir = sys.argv[2]
+url_base = lambda url: re.findall("/subtitles/(.*)/(?:japanese|english)", url)[0]
+
+
+# downloads into the same dest (e.g. two urls for one title) take turns, so
+#   should_skip sees the outcome of the one before
+DEST_LOCKS = collections.defaultdict(threading.Lock)
+DEST_LOCKS_LOCK = threading.Lock()
+
+def dest_lock(dest):
+    with DEST_LOCKS_LOCK:
+        return DEST_LOCKS[dest]
+
 
-def process_url(url, language):
+def process_url(url, language, base_dir, downloader, converters, args):
     try:
+        url = rebase(url, args.base_url)
         title = url_base(url)
-        if should_skip(base_dir, title, language):
-            print 'SKIPPED ', url
-            return
-
         dest = os.path.join(base_dir, title, language)
-        if dl_and_convert(dest, url, title):
-            print 'SUCCESS ON', url
-        else:
-            print 'FAILURE ON ', url
+        with dest_lock(dest):
+            if should_skip(base_dir, title, language):
+                print 'SKIPPED ', url
+                return 'skipped'
+
+            if dl_and_convert(dest, url, title, downloader, converters, args.retries, args.backoff):
+                print 'SUCCESS ON', url
+                return 'success'
+            else:
+                print 'FAILURE ON ', url
+                return 'failure'
     except Exception as e:
         print 'MYSTERIOUS FAILURE ON: ', url, ' WITH EXCEPTION ', e
+        return 'failure'
 
 
-urls = sys.argv[1]
-url_f = open(urls)
-language = 'ja' if 'ja' in urls else 'en'
-url_base = lambda url: re.findall("https://subscene.com/subtitles/(.*)/[japanese|english]", url)[0]
-driver = webdriver.Chrome()
-driver.set_page_load_timeout(10)   # 10 second limit 
-
-
-for i, url in tqdm(enumerate(url_f), total=file_length(sys.argv[1])):
-    process_url(url, language)
-
-#Parallel(n_jobs=4)(delayed(process_url)(url) for url in ja_urls)
-
+def main(args):
+    urls = [url.strip() for url in open(args.urls) if url.strip()]
+    language = 'ja' if 'ja' in args.urls else 'en'
+    done = CheckpointStore(args.state or args.urls + '.done')
+    converters = Pool(args.convert_jobs)   # before any threads start
+    downloader = Downloader(RateLimiter(args.rate), size=args.threads, mode=args.mode,
+                            browser_fallback=args.browser_fallback)
+    progress = tqdm(total=len([url for url in urls if url not in done]))
 
+    def work(url):
+        try:
+            return process_url(url, language, args.base_dir, downloader, converters, args)
+        finally:
+            progress.update(1)
 
+    try:
+        outcomes = crawl(urls, work, workers=args.threads, done=done)
+    finally:
+        progress.close()
+        downloader.close()
+        converters.close()
+        converters.join()
+    print 'DONE: ', ', '.join('%s %d' % (k, n) for (k, n) in sorted(outcomes.items()))
 
 
+if __name__ == '__main__':
+    main(process_command_line())
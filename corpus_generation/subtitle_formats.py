@@ -0,0 +1,351 @@
+"""
+=== DESCRIPTION
+Turns a downloaded subtitle file (or an archive of them) into .srt files, in memory.
+
+Archives are opened from the downloaded bytes: zip always, rar if the rarfile
+    module is installed, and anything else pyunpack can handle (7z, ...) via a
+    temp dir. Archives inside archives are opened too.
+
+Every file in the download is sniffed by content, not extension:
+    srt                   written as is
+    ass / ssa             converted here
+    microdvd (.sub)       converted here ({start frame}{end frame}text)
+    webvtt                converted here
+    other subtitle types  handed to ffmpeg (see FFMPEG_EXTENSIONS)
+    anything else         (nfo, txt, images, ...) dropped, unless it's named
+                          .srt: those are written as is (e.g. bom-less utf16)
+
+Converted files keep their original bytes where they weren't utf8/16 to begin
+    with (all_to_utf8.py deals with encodings later); utf16 comes out as utf8.
+
+=== USAGE
+written = convert_download(downloaded_bytes, 'data/title/ja', 'title-1234')
+    => [paths of the .srt files written]
+
+python subtitle_formats.py [subtitle or archive file] [out dir]
+"""
+import os
+import re
+import io
+import sys
+import shutil
+import zipfile
+import zlib
+import tempfile
+from pyunpack import Archive
+from ffmpy import FFmpeg
+try:
+    import rarfile
+except ImportError:
+    rarfile = None
+
+
+MAX_DEPTH = 3      # archives in archives in archives
+FFMPEG_EXTENSIONS = ('.smi', '.sami', '.ttml', '.dfxp', '.sub', '.sbv', '.mpl2')
+DEFAULT_FPS = 23.976
+
+ARCHIVE_MAGIC = [
+    ('zip', 'PK\x03\x04'),
+    ('rar', 'Rar!\x1a\x07'),
+    ('7z', '7z\xbc\xaf\x27\x1c'),
+    ('gz', '\x1f\x8b'),
+    ('bz2', 'BZh'),
+]
+
+SRT_START = re.compile(r'^\s*(?:\d+\s*\r?\n\s*)?\d+:\d+:\d+[,.]\d+\s*-->', re.U)   # the index is often missing
+MICRODVD_LINE = re.compile(r'^\{(\d+)\}\{(\d*)\}(.*)$', re.U)
+MICRODVD_TAG = re.compile(r'\{[a-zA-Z]:[^}]*\}', re.U)
+ASS_TIME = re.compile(r'(\d+):(\d+):(\d+)[.:](\d+)', re.U)
+ASS_OVERRIDE = re.compile(r'\{[^}]*\}', re.U)
+VTT_TIME = re.compile(r'(?:(\d+):)?(\d+):(\d+)[.,](\d+)', re.U)
+
+# line handling has to leave non-ascii alone: anything decoded as latin-1 (see decode),
+#   e.g. shift-jis that didn't round trip, can be full of \x85 and \xa0, which
+#   splitlines() breaks on and strip() removes
+LINE_BREAK = re.compile(u'\r?\n')
+BLANK = u' \t\r'
+KANA = re.compile(u'[\u3040-\u30ff]')
+
+
+def archive_type(data):
+    for kind, magic in ARCHIVE_MAGIC:
+        if data.startswith(magic):
+            return kind
+    return None
+
+
+def decode(data):
+    """ returns: (text, encoding to write text back out in). shift-jis comes
+        back as cp932 if it round trips (its second bytes include { } | \\,
+        which the converters would take apart as latin-1); anything else that
+        isn't utf8/16 comes back latin-1 decoded, which round trips its bytes
+    """
+    for bom, codec in [('\xef\xbb\xbf', 'utf-8-sig'), ('\xff\xfe', 'utf-16'), ('\xfe\xff', 'utf-16')]:
+        if data.startswith(bom):
+            return data.decode(codec), 'utf8'
+    try:
+        return data.decode('utf8'), 'utf8'
+    except UnicodeDecodeError:
+        pass
+    try:
+        text = data.decode('cp932')
+        # kana, or it's more likely cp1252 that happens to decode
+        if KANA.search(text) and text.encode('cp932') == data:
+            return text, 'cp932'
+    except UnicodeError:
+        pass
+    return data.decode('latin-1'), 'latin-1'
+
+
+def split_lines(text):
+    return LINE_BREAK.split(text)
+
+
+def sniff(text):
+    """ returns: 'srt', 'ass', 'microdvd', 'vtt' or None
+    """
+    head = text[:4096].lstrip(u'\ufeff')
+    if head.lstrip(BLANK + u'\n').startswith(u'WEBVTT'):
+        return 'vtt'
+    if SRT_START.match(head):
+        return 'srt'
+    if u'[Script Info]' in head or u'[Events]' in text and u'\nDialogue:' in text:
+        return 'ass'
+    for line in split_lines(head):
+        if line.strip(BLANK):
+            return 'microdvd' if MICRODVD_LINE.match(line.strip(BLANK)) else None
+    return None
+
+
+def format_time(ms):
+    ms = max(0, int(round(ms)))
+    return '%02d:%02d:%02d,%03d' % (ms // 3600000, ms // 60000 % 60, ms // 1000 % 60, ms % 1000)
+
+
+def format_srt(captions):
+    """ captions: [(start ms, end ms, text)] => srt text
+    """
+    blocks = []
+    for i, (start, end, text) in enumerate(captions):
+        blocks.append(u'%d\n%s --> %s\n%s\n' % (i + 1, format_time(start), format_time(end), text))
+    return u'\n'.join(blocks)
+
+
+def ass_time(t):
+    h, m, s, frac = ASS_TIME.match(t.strip(BLANK)).groups()
+    # centiseconds normally, but be lenient about the number of digits
+    return ((int(h) * 60 + int(m)) * 60 + int(s)) * 1000 + int(round(float('0.' + frac) * 1000))
+
+
+def ass_to_captions(text):
+    fields = None
+    in_events = False
+    captions = []
+    for line in split_lines(text):
+        line = line.strip(BLANK)
+        if line.startswith(u'['):
+            in_events = line.lower() == u'[events]'
+            continue
+        if not in_events:
+            continue
+        if line.startswith(u'Format:'):
+            fields = [f.strip(BLANK).lower() for f in line[len(u'Format:'):].split(u',')]
+        elif line.startswith(u'Dialogue:'):
+            names = fields or [u'layer', u'start', u'end', u'style', u'name',
+                               u'marginl', u'marginr', u'marginv', u'effect', u'text']
+            values = line[len(u'Dialogue:'):].split(u',', len(names) - 1)
+            if len(values) < len(names):
+                continue
+            row = dict(zip(names, values))
+            caption = ASS_OVERRIDE.sub(u'', row[u'text'])
+            caption = caption.replace(u'\\N', u'\n').replace(u'\\n', u'\n').replace(u'\\h', u' ')
+            caption = u'\n'.join(l.strip(BLANK) for l in caption.split(u'\n') if l.strip(BLANK))
+            if caption:
+                try:
+                    captions.append((ass_time(row[u'start']), ass_time(row[u'end']), caption))
+                except AttributeError:
+                    continue   # unparseable time
+    captions.sort(key=lambda c: c[0])
+    return captions
+
+
+def microdvd_to_captions(text, fps=DEFAULT_FPS):
+    captions = []
+    for line in split_lines(text):
+        m = MICRODVD_LINE.match(line.strip(BLANK))
+        if not m:
+            continue
+        start, end, caption = m.groups()
+        caption = MICRODVD_TAG.sub(u'', caption).strip(BLANK)
+        if start == u'1' and end == u'1' and not captions:
+            # the first line may give the frame rate instead of a caption
+            try:
+                fps = float(caption)
+                continue
+            except ValueError:
+                pass
+        start = int(start)
+        end = int(end) if end else start + int(fps * 2)
+        caption = u'\n'.join(l.strip(BLANK) for l in caption.split(u'|') if l.strip(BLANK))
+        if caption:
+            captions.append((start * 1000.0 / fps, end * 1000.0 / fps, caption))
+    return captions
+
+
+def vtt_time(t):
+    h, m, s, frac = VTT_TIME.match(t.strip(BLANK)).groups()
+    return ((int(h or 0) * 60 + int(m)) * 60 + int(s)) * 1000 + int(frac.ljust(3, '0')[:3])
+
+
+def vtt_to_captions(text):
+    captions = []
+    for block in re.split(u'\r?\n\s*\r?\n', text):
+        lines = [l for l in split_lines(block) if l.strip(BLANK)]
+        for i, line in enumerate(lines):
+            if u'-->' in line:
+                start, end = line.split(u'-->', 1)
+                try:
+                    captions.append((vtt_time(start), vtt_time(end.strip(BLANK).split(u' ')[0]),
+                                     u'\n'.join(l.strip(BLANK) for l in lines[i + 1:])))
+                except (AttributeError, IndexError):
+                    pass
+                break
+    return [c for c in captions if c[2]]
+
+
+CONVERTERS = {
+    'ass': ass_to_captions,
+    'microdvd': microdvd_to_captions,
+    'vtt': vtt_to_captions,
+}
+
+
+def to_srt(data):
+    """ returns: srt bytes, or None if data isn't a subtitle format we can convert
+    """
+    text, encoding = decode(data)
+    kind = sniff(text)
+    if kind == 'srt':
+        return data if encoding != 'utf8' else text.encode('utf8')
+    if kind not in CONVERTERS:
+        return None
+    captions = CONVERTERS[kind](text)
+    if len(captions) == 0:
+        return None
+    return format_srt(captions).encode(encoding)
+
+
+def unpack(name, data, depth=0):
+    """ yields (file name, bytes) for every file in a download, opening archives
+    """
+    kind = archive_type(data)
+    if kind is None or depth > MAX_DEPTH:
+        yield name, data
+        return
+    if kind == 'zip':
+        try:
+            members = zipfile.ZipFile(io.BytesIO(data))
+            for info in members.infolist():
+                if not info.filename.endswith('/'):
+                    for item in unpack(info.filename, members.read(info), depth + 1):
+                        yield item
+            return
+        except (zipfile.BadZipfile, zipfile.LargeZipFile, zlib.error, IOError, RuntimeError):
+            pass   # e.g. encrypted or not really a zip; let pyunpack have a go
+    if kind == 'rar' and rarfile is not None:
+        try:
+            members = rarfile.RarFile(io.BytesIO(data))
+            for info in members.infolist():
+                if not info.isdir():
+                    for item in unpack(info.filename, members.read(info), depth + 1):
+                        yield item
+            return
+        except (rarfile.Error, IOError):
+            pass
+    for item in unpack_on_disk(name, data, depth):
+        yield item
+
+
+def unpack_on_disk(name, data, depth):
+    """ fallback for archives we can't open in memory
+    """
+    tmp = tempfile.mkdtemp(prefix='jesc_unpack_')
+    try:
+        archive = os.path.join(tmp, 'archive.' + (archive_type(data) or 'bin'))
+        with open(archive, 'wb') as f:
+            f.write(data)
+        out = os.path.join(tmp, 'out')
+        os.makedirs(out)
+        try:
+            Archive(archive).extractall(out)
+        except Exception:
+            return
+        for root, _, files in os.walk(out):
+            for f in files:
+                with open(os.path.join(root, f), 'rb') as member:
+                    contents = member.read()
+                for item in unpack(f, contents, depth + 1):
+                    yield item
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def ffmpeg_to_srt(name, data):
+    """ returns: srt bytes from ffmpeg, or None if it couldn't convert
+    """
+    tmp = tempfile.mkdtemp(prefix='jesc_ffmpeg_')
+    try:
+        source = os.path.join(tmp, 'in' + os.path.splitext(name)[1].lower())
+        target = os.path.join(tmp, 'out.srt')
+        with open(source, 'wb') as f:
+            f.write(data)
+        FFmpeg(inputs={source: None}, outputs={target: None},
+               global_options='-loglevel error -y').run()
+        with open(target, 'rb') as f:
+            return f.read()
+    except Exception:
+        return None
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def safe_name(name):
+    if isinstance(name, unicode):
+        name = name.encode('utf8')
+    return os.path.basename(name.replace('\\', '/')) or 'subtitle'
+
+
+def convert_download(data, dest, name):
+    """ writes every subtitle in a downloaded file to dest as .srt. a download
+        that isn't an archive gets called name.srt
+
+        returns: [paths written]
+    """
+    if not os.path.exists(dest):
+        try:
+            os.makedirs(dest)
+        except OSError:
+            pass
+    written = []
+    for member, contents in unpack(name, data):
+        member = safe_name(member)
+        srt = to_srt(contents)
+        if srt is None and os.path.splitext(member)[1].lower() in FFMPEG_EXTENSIONS:
+            srt = ffmpeg_to_srt(member, contents)
+        if srt is None and member.lower().endswith('.srt'):
+            srt = contents   # the sniff missed it; keep it as downloaded, like the crawler always did
+        if srt is None:
+            continue
+        # same naming as before: subs.srt stays, subs.ass becomes subs.ass.srt
+        target = os.path.join(dest, member if member.lower().endswith('.srt') else member + '.srt')
+        with open(target, 'wb') as f:
+            f.write(srt)
+        written.append(target)
+    return written
+
+
+if __name__ == '__main__':
+    source, dest = sys.argv[1], sys.argv[2]
+    with open(source, 'rb') as f:
+        written = convert_download(f.read(), dest, os.path.basename(source))
+    print 'WROTE %d FILES: ' % len(written), ', '.join(written)
@@ -0,0 +1,189 @@
+"""
+=== DESCRIPTION
+A persisted, memory-mappable cache of preprocessed subtitle files (.jescidx),
+    so re-runs over the same crawl skip parsing, cleaning, stemming and
+    translation and go straight to scoring. What gets stored is up to the
+    caller (see Aligner.pack_ja / Aligner.pack_en); this module only handles
+    the container and invalidation.
+
+Artifacts live in their own directory (never next to the srts, where they'd be
+    picked up as subtitles), one per srt, named by the hash of its path.
+    An artifact is stale once its srt changes: same mtime and size is trusted,
+    otherwise the srt's md5 has to match the one recorded at write time. It's
+    also stale if it was written under another FORMAT_VERSION or tag.
+
+=== FORMAT
+    8 bytes    magic, 'JESCIDX1'
+    4 bytes    header length (little endian uint32)
+    header     utf8 json: {version, source, mtime, size, md5, kind, tag, meta, arrays}
+               arrays is [ {name, dtype, shape, offset} ], offsets from the start of the file
+    data       raw array bytes, each one 8-byte aligned
+
+=== USAGE
+index = SubtitleIndex('index_dir', tag='./trans')
+index.save(srt, 'en', {'starts': np.array(...)}, meta={'en_start': 3})
+found = index.load(srt, 'en')     # None if missing or stale
+found['meta'], found['arrays']['starts']
+"""
+import os
+import json
+import mmap
+import struct
+import hashlib
+import tempfile
+import numpy as np
+import metrics
+
+
+MAGIC = 'JESCIDX1'
+ALIGN = 8
+# bump whenever the code behind what's stored changes: utils.clean_caption,
+#   tf_idf's tokenizing / stemming, or Aligner.pack_ja / pack_en
+FORMAT_VERSION = 1
+
+
+def file_md5(path):
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def pack_strings(strings):
+    """ [unicode] => (utf8 bytes as a uint8 array, int64 byte offsets)
+    """
+    encoded = [s.encode('utf8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in encoded], out=offsets[1:])
+    return np.frombuffer(''.join(encoded), dtype=np.uint8), offsets
+
+
+def unpack_strings(buf, offsets):
+    """ inverse of pack_strings
+    """
+    data = buf.tostring()
+    o = offsets.tolist()
+    return [data[o[i]:o[i + 1]].decode('utf8') for i in range(len(o) - 1)]
+
+
+def write_index(path, header, arrays):
+    """ writes header + arrays to path, atomically (tmp file + rename)
+    """
+    arrays = [(name, np.ascontiguousarray(a)) for (name, a) in sorted(arrays.items())]
+    # the data offsets depend on the header length, which depends on the offsets
+    #   (as digits), so lay out with a guess and repeat until it's stable
+    header_len = 0
+    while True:
+        offset = len(MAGIC) + 4 + header_len
+        specs = []
+        for name, a in arrays:
+            offset += -offset % ALIGN
+            specs.append({'name': name, 'dtype': a.dtype.str, 'shape': list(a.shape), 'offset': offset})
+            offset += a.nbytes
+        header['arrays'] = specs
+        encoded = json.dumps(header)
+        if len(encoded) == header_len:
+            break
+        header_len = len(encoded)
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC + struct.pack('<I', header_len) + encoded)
+            for spec, (name, a) in zip(specs, arrays):
+                f.write('\0' * (spec['offset'] - f.tell()))
+                f.write(a.tostring())
+        os.chmod(tmp, 0644)
+        os.rename(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def read_index(path):
+    """ maps an index file
+
+        returns: (header, {name: read-only np.array backed by the mapping})
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('not a .jescidx file: %s' % path)
+        header_len = struct.unpack('<I', f.read(4))[0]
+        header = json.loads(f.read(header_len))
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    arrays = {}
+    for spec in header['arrays']:
+        dtype = np.dtype(str(spec['dtype']))
+        count = int(np.prod(spec['shape'])) if spec['shape'] else 1
+        a = np.frombuffer(data, dtype=dtype, count=count, offset=spec['offset'])
+        arrays[spec['name']] = a.reshape(spec['shape'])
+    return header, arrays
+
+
+class SubtitleIndex():
+    def __init__(self, index_dir, tag=''):
+        """ tag: anything else the stored data depends on (e.g. the translator).
+            artifacts written under a different tag are stale
+        """
+        self.index_dir = index_dir
+        self.tag = tag
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(index_dir):
+            try:
+                os.makedirs(index_dir)
+            except OSError:
+                pass   # another worker made it first
+
+
+    def path(self, srt):
+        key = hashlib.sha1(os.path.abspath(srt)).hexdigest()
+        return os.path.join(self.index_dir, key + '.jescidx')
+
+
+    def fresh(self, header, srt, kind):
+        if header.get('version') != FORMAT_VERSION:
+            return False
+        if header.get('kind') != kind or header.get('tag') != self.tag:
+            return False
+        if header.get('source') != os.path.abspath(srt):
+            return False
+        st = os.stat(srt)
+        if st.st_size != header.get('size'):
+            return False
+        return st.st_mtime == header.get('mtime') or file_md5(srt) == header.get('md5')
+
+
+    def load(self, srt, kind):
+        """ returns: {'meta': {}, 'arrays': {name: np.array}}, or None if
+            there's no fresh artifact for srt
+        """
+        path = self.path(srt)
+        try:
+            header, arrays = read_index(path)
+            if self.fresh(header, srt, kind):
+                self.hits += 1
+                metrics.count('index_hits')
+                return {'meta': header['meta'], 'arrays': arrays}
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        self.misses += 1
+        metrics.count('index_misses')
+        return None
+
+
+    def save(self, srt, kind, arrays, meta=None):
+        st = os.stat(srt)
+        header = {
+            'version': FORMAT_VERSION,
+            'source': os.path.abspath(srt),
+            'mtime': st.st_mtime,
+            'size': st.st_size,
+            'md5': file_md5(srt),
+            'kind': kind,
+            'tag': self.tag,
+            'meta': meta or {},
+        }
+        write_index(self.path(srt), header, arrays)
@@ -9,31 +9,86 @@ tfidf = TF_IDF(srt_file)
 score = tfidf.similarity(ref, trans):
     ref: [ [words] ], in the srt_file,  PRECONDITION: cleaned
     trans: [ [words] ], to be compared, PRECONDITION: not cleaned
+
+scores = tfidf.similarity_many(refs, trans):
+    refs: [ ref ], a whole candidate window, scored in one sparse product
 ```
+
+The prepared corpus and idf table are cached by the srt_file's content hash, so
+    re-loading the same en file (e.g. against several ja files) skips the rebuild.
+    TF_IDF(srt_file, vocab=...) restores a saved vocabulary (see subtitle_index.py).
+
+tf-idf vectors are sparse rows (scipy CSR) over the vocabulary of the srt_file,
+    and the reference captions are stacked into a single CSR matrix.
 """
-import pysrt
 import re
 import nltk
 from nltk.tokenize import word_tokenize
 import Stemmer
 import math
-from utils import clean_caption
+import hashlib
+import numpy as np
+from scipy import sparse
+from utils import clean_caption, clean_caption_cached, LRUCache
+from srt_reader import load_srt
 from unicodedata import category
 import collections
 
 
+# content hash => (prepared corpus, idf table)
+IDF_CACHE = LRUCache(maxsize=64)
+
+
+def file_hash(path):
+    """ md5 of a file's contents
+    """
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
 class TF_IDF():
-    def __init__(self, subfile):
-        self.subs = pysrt.open(subfile)
+    def __init__(self, subfile, vocab=None):
+        """ vocab: [(token, idf)] in id order (see vocab_table), to restore a saved
+            vocabulary instead of rebuilding it from subfile. a restored TF_IDF can
+            vectorize and score new sentences, but has no corpus rows
+        """
         self.stemmer = Stemmer.Stemmer('english')
+        if vocab is not None:
+            self.subs = None
+            self.idf = dict(vocab)
+            self.vocab = dict((tok, i) for i, (tok, _) in enumerate(vocab))
+            self.row_index = {}
+            self.tfidf_matrix = self.build_tfidf_matrix([])
+            self.row_norms = self.magnitudes(self.tfidf_matrix)
+            return
 
-        corpus = self.prepare_corpus()
+        self.subs = load_srt(subfile)
+        key = file_hash(subfile)
+        cached = IDF_CACHE.get(key)
+        if cached is None:
+            corpus = self.prepare_corpus()
+            cached = (corpus, self.inverse_document_frequency(corpus))
+            IDF_CACHE.put(key, cached)
+        corpus, self.idf = cached
+        self.vocab = dict((tok, i) for i, tok in enumerate(self.idf))
 
-        self.idf = self.inverse_document_frequency(corpus)
+        # one row per caption. captions that join to the same key share
+        #   a row, and (like a dict) the last one wins
+        self.row_index = {}
+        for i, s in enumerate(corpus):
+            self.row_index[''.join(w for w in s)] = i
+        self.tfidf_matrix = self.build_tfidf_matrix(corpus)
+        self.row_norms = self.magnitudes(self.tfidf_matrix)
 
-        self.tfidf_vecs = {}
-        for s in corpus:
-            self.tfidf_vecs[''.join(w for w in s)] = self.build_tfidf_vec(s)
+
+    def vocab_table(self):
+        """ returns: ([tokens], np.array of idfs), both in vocabulary id order
+        """
+        tokens = sorted(self.vocab, key=self.vocab.get)
+        return tokens, np.array([self.idf[tok] for tok in tokens], dtype=np.float64)
 
 
     def prepare_corpus(self):
@@ -46,8 +101,8 @@ class TF_IDF():
         """
         out_raw = []
         out = []
-        for sub in self.subs:
-            caption = clean_caption(sub.text)
+        for text in self.subs.texts():
+            caption = clean_caption_cached(text)
             if len(caption) == 0:
                 continue
             out.append(self.prep_cleaned_caption(caption))
@@ -67,32 +122,48 @@ class TF_IDF():
         return s_new
 
 
+    def magnitudes(self, m):
+        """ l2 norm of each row of a sparse matrix
+        """
+        return np.sqrt(np.asarray(m.multiply(m).sum(axis=1)).ravel())
+
+
     def cosine_similarity(self, v1, v2):
         """ cosine similarity: v1 * v2 / |v1| |v2}
+              v1, v2: sparse (1 x V) rows
         """
-        def magnitude(v):
-            return math.sqrt(sum([x**2 for x in v]))
-
-        dot = sum(a*b for a,b in zip(v1, v2))
+        dot = v1.multiply(v2).sum()
         if not dot:   # short circuit 
             return 0
-        mag = magnitude(v1) * magnitude(v2)
+        mag = self.magnitudes(v1)[0] * self.magnitudes(v2)[0]
         if not mag:
             return 0
         return dot * 1.0 / mag
 
 
+    def build_tfidf_matrix(self, sentences):
+        """ builds a sparse (len(sentences) x V) tf-idf matrix, one row per sentence.
+            tokens that aren't in the vocabulary are dropped
+        """
+        data = []
+        indices = []
+        indptr = [0]
+        for s in sentences:
+            for tok, freq in collections.Counter(s).items():
+                if tok not in self.vocab:
+                    continue
+                indices.append(self.vocab[tok])
+                data.append((1 + math.log(freq)) * self.idf[tok])
+            indptr.append(len(indices))
+        return sparse.csr_matrix(
+            (np.array(data, dtype=np.float64), np.array(indices, dtype=np.int32), indptr),
+            shape=(len(sentences), len(self.vocab)))
+
+
     def build_tfidf_vec(self, s):
-        """ builds a tf-idf vector for a sentance s
+        """ builds a tf-idf vector (sparse 1 x V row) for a sentance s
         """
-        word_freqs = collections.Counter(s)
-        
-        # todo - list comprehension might be a hair faster?
-        out = []
-        for (tok, idf_val) in self.idf.items():
-            tf = (1 + math.log(word_freqs[tok])) if word_freqs[tok] else 0
-            out.append(tf * idf_val)
-        return out
+        return self.build_tfidf_matrix([s])
 
 
     def similarity(self, ref, trans):
@@ -106,7 +177,7 @@ class TF_IDF():
             trans = clean_caption(trans)
             trans = self.prep_cleaned_caption(trans)
 
-            ref_tfidf = self.tfidf_vecs[''.join(w for w in ref)]
+            ref_tfidf = self.tfidf_matrix[self.row_index[''.join(w for w in ref)]]
             trans_tfidf = self.build_tfidf_vec(trans)
 
             return self.cosine_similarity(ref_tfidf, trans_tfidf), ref_tfidf, trans_tfidf
@@ -115,13 +186,78 @@ class TF_IDF():
             return 0, None, None
 
 
+    def similarity_many(self, refs, trans):
+        """ tf-idf similarity between one translation and a whole window of refs,
+            scored with a single sparse matrix-vector product.
+             refs: [ ref ], in corpus, PRECONDITION: cleaned
+             trans: [ [words] ], to be compared, PRECONDITION: unclean
+
+             returns: np.array of similarities, one per ref (0 for unknown refs)
+        """
+        trans = self.prep_caption(trans)
+        if trans is None:
+            return np.zeros(len(refs))
+        refs_m, _ = self.ref_matrix(refs)
+        return self.similarity_matrix(refs_m, self.build_tfidf_vec(trans))[0]
+
+
+    def prep_caption(self, s):
+        """ cleans, strips and stems an unclean caption. .jescidx files store its
+            output, so changes here need a subtitle_index.FORMAT_VERSION bump
+
+            returns: [words], or None if s can't be prepped (e.g. a missing translation)
+        """
+        try:
+            return self.prep_cleaned_caption(clean_caption(s))
+        except:
+            return None
+
+
+    def ref_matrix(self, refs):
+        """ stacks the corpus tf-idf rows for a list of refs into one sparse matrix.
+             refs: [ ref ], PRECONDITION: cleaned
+
+             returns: (sparse (len(refs) x V) matrix, np.array of bools: was the ref in the corpus).
+                      refs that aren't in the corpus get an empty row
+        """
+        rows = []
+        for ref in refs:
+            try:
+                key = ''.join(w for w in self.prep_cleaned_caption(ref))
+            except:
+                key = None
+            rows.append(self.row_index.get(key, -1))
+        rows = np.array(rows, dtype=np.int64)
+        known = rows >= 0
+        if len(rows) == 0:
+            return sparse.csr_matrix((0, len(self.vocab))), known
+
+        m = self.tfidf_matrix[np.where(known, rows, 0)]
+        m = sparse.diags(known.astype(np.float64)).dot(m).tocsr()
+        return m, known
+
+
+    def similarity_matrix(self, refs_m, trans_m):
+        """ cosine similarity of every trans row against every ref row, in one sparse product
+
+            returns: dense (num trans x num refs) np.array
+        """
+        dots = trans_m.dot(refs_m.T).toarray()
+        mags = np.outer(self.magnitudes(trans_m), self.magnitudes(refs_m))
+        sims = np.zeros(dots.shape)
+        ok = (dots != 0) & (mags != 0)
+        sims[ok] = dots[ok] / mags[ok]
+        return sims
+
+
     def inverse_document_frequency(self, corpus):
-        """ the "idf" part of tf-idf
+        """ the "idf" part of tf-idf. document frequencies are counted in
+            one pass over the corpus, using each caption's token set
         """
-        idf_vals = {}
-        all_tokens = set([w for s in corpus for w in s])
-        for tok in all_tokens:
-            contains_tok = map(lambda s: tok in s, corpus)
-            idf_vals[tok] = math.log(len(corpus) * 1.0 / sum(contains_tok))
-        return idf_vals
+        doc_freqs = collections.Counter()
+        for s in corpus:
+            doc_freqs.update(set(s))
+
+        n = len(corpus) * 1.0
+        return dict((tok, math.log(n / df)) for tok, df in doc_freqs.items())
 
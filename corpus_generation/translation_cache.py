@@ -0,0 +1,174 @@
+"""
+=== DESCRIPTION
+A persistent, content-addressed translation cache that sits in front of
+    a translator (see translator.py). Entries are keyed by the sha1 of the
+    normalized ja caption and live in a SQLite file, so they're shared across
+    runs and across the pool workers of parser_v4.
+
+The cache is capped at max_entries; when it grows past the cap the least
+    recently used entries are evicted. Counting rows is a full scan, so each
+    connection only checks the size after every evict_every rows it inserts
+    (the table can overshoot the cap by about that much per process).
+
+=== USAGE
+t = CachingTranslator(CommandTranslator(), 'translations.db')
+t.translate_many([captions])
+print t.cache.hits, t.cache.misses
+"""
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+from translator import Translator, normalize_ja
+import metrics
+
+
+def caption_key(ja):
+    """ cache key for a normalized ja caption
+    """
+    return hashlib.sha1(ja.encode('utf8')).hexdigest()
+
+
+class TranslationCache():
+    """ sqlite key/value store: caption key => translation, with lru eviction.
+
+        every process and thread opens its own connection (sqlite connections don't
+        survive a fork or cross threads), and the database runs in WAL mode so
+        readers never block the writer
+    """
+    BATCH = 500   # stay under sqlite's bound-variable limit
+
+    def __init__(self, path, max_entries=1000000, evict_every=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.evict_every = evict_every or max(1, min(10000, max_entries // 100))
+        self.hits = 0
+        self.misses = 0
+        self.local = threading.local()
+
+
+    def connect(self):
+        if getattr(self.local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS translations '
+                         '(key TEXT PRIMARY KEY, ja TEXT, trans TEXT, used REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS translations_used ON translations (used)')
+            conn.commit()
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+            self.local.unchecked = self.evict_every   # check on the first put
+        return self.local.conn
+
+
+    def get_many(self, keys):
+        """ returns: {key: translation} for the keys that are cached
+        """
+        conn = self.connect()
+        found = {}
+        keys = list(set(keys))
+        now = time.time()
+        with conn:
+            for i in range(0, len(keys), self.BATCH):
+                chunk = keys[i:i + self.BATCH]
+                marks = ','.join('?' * len(chunk))
+                rows = conn.execute('SELECT key, trans FROM translations WHERE key IN (%s)' % marks, chunk)
+                found.update(rows.fetchall())
+                conn.execute('UPDATE translations SET used = ? WHERE key IN (%s)' % marks, [now] + chunk)
+        return found
+
+
+    def put_many(self, items):
+        """ stores [(key, ja, translation)], then evicts down to max_entries
+        """
+        if len(items) == 0:
+            return
+        conn = self.connect()
+        now = time.time()
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?)',
+                             [(key, ja, trans, now) for (key, ja, trans) in items])
+            self.local.unchecked += len(items)
+            if self.local.unchecked >= self.evict_every:
+                self.evict(conn)
+                self.local.unchecked = 0
+
+
+    def evict(self, conn):
+        size = conn.execute('SELECT COUNT(*) FROM translations').fetchone()[0]
+        if size > self.max_entries:
+            conn.execute('DELETE FROM translations WHERE key IN '
+                         '(SELECT key FROM translations ORDER BY used LIMIT ?)',
+                         (size - self.max_entries,))
+
+
+    def __len__(self):
+        return self.connect().execute('SELECT COUNT(*) FROM translations').fetchone()[0]
+
+
+class CachingTranslator(Translator):
+    """ wraps a translator with a TranslationCache. failed translations ('')
+        aren't cached, so they get retried next time
+    """
+    def __init__(self, translator, path, max_entries=1000000):
+        self.translator = translator
+        self.cache = TranslationCache(path, max_entries)
+
+
+    def translate_normalized(self, ja):
+        return self.translate_many([ja])[0]
+
+
+    def translate_many(self, captions):
+        out = [None] * len(captions)
+        pending = []   # (index, normalized caption, key)
+        for i, caption in enumerate(captions):
+            try:
+                ja = normalize_ja(caption)
+            except:
+                out[i] = ''
+                continue
+            if len(ja) > 0:
+                pending.append((i, ja, caption_key(ja)))
+        if len(pending) == 0:
+            return out
+
+        try:
+            cached = self.cache.get_many([key for (_, _, key) in pending])
+        except sqlite3.Error:
+            cached = {}
+
+        misses = []
+        for (i, ja, key) in pending:
+            if key in cached:
+                self.cache.hits += 1
+                out[i] = cached[key]
+            else:
+                self.cache.misses += 1
+                misses.append((i, ja, key))
+        metrics.count('trans_cache_hits', len(pending) - len(misses))
+        metrics.count('trans_cache_misses', len(misses))
+        if len(misses) == 0:
+            return out
+
+        # repeated lines within a batch only get translated once
+        unique = {}
+        for (_, ja, key) in misses:
+            unique.setdefault(key, ja)
+        keys = unique.keys()
+        translations = dict(zip(keys, self.translator.translate_many([unique[key] for key in keys])))
+
+        for (i, _, key) in misses:
+            out[i] = translations[key]
+        new = [(key, unique[key], trans) for (key, trans) in translations.items() if trans]
+        try:
+            self.cache.put_many(new)
+        except sqlite3.Error:
+            pass
+        return out
+
+
+    def close(self):
+        self.translator.close()
@@ -0,0 +1,263 @@
+"""
+=== DESCRIPTION
+Pluggable translation backends for the aligner. A translator takes cleaned
+    ja captions and produces approximate (lowercased) en translations.
+
+=== USAGE
+t = CommandTranslator()                  # one `./trans ja: <caption>` process per caption
+t = WorkerTranslator('./my_worker ja:en') # one long-lived process, captions over stdin/stdout
+t = StubTranslator({u'hai': 'yes'})      # no external process, for tests
+
+t.translate(caption)           => translation
+t.translate_many([captions])   => [translations]
+
+=== WORKER PROTOCOL
+A worker reads one caption per line (utf8) on stdin and writes exactly one
+    translation per line on stdout, flushing after every line. A worker that
+    goes `timeout` seconds without answering, or fails mid-batch, is killed and
+    restarted on the next call, so a half-read batch can't be paired with the
+    next one's captions.
+"""
+# -*- coding: utf-8 -*-
+import os
+import time
+import select
+import string
+import subprocess
+import threading
+from multiprocessing.pool import ThreadPool
+
+
+def normalize_ja(caption):
+    """ deletes whitespace (including ideographic spaces) from a ja caption
+    """
+    ja = caption.replace(u' ', u'').replace(u'\u3000', u'')
+    return ja.strip(u' \t\n\r\x0b\x0c')
+
+
+def clean_translation(result):
+    """ keeps printable characters, lowercases
+    """
+    return ''.join([char for char in result if char in string.printable]).lower()
+
+
+class Translator():
+    """ base class. subclasses implement translate_normalized()
+        and can override translate_many() with a batched version
+    """
+    def translate(self, caption):
+        """ produces an approximate translation of a cleaned ja caption
+
+            returns: translation (str), None for empty captions, '' on failure
+        """
+        try:
+            ja = normalize_ja(caption)
+            if len(ja) == 0:
+                return None
+            return self.translate_normalized(ja)
+        except:
+            return ''
+
+
+    def translate_many(self, captions):
+        """ translates a list of cleaned ja captions
+
+            returns: [translation], same contract as translate()
+        """
+        return [self.translate(caption) for caption in captions]
+
+
+    def translate_normalized(self, ja):
+        raise NotImplementedError
+
+
+    def close(self):
+        pass
+
+
+class CommandTranslator(Translator):
+    """ forks `cmd ja: <caption>` once per caption (the original backend).
+        translate_many() keeps up to `jobs` of these processes in flight, per
+        calling process (so jobs x parser_v4's --threads in all)
+    """
+    def __init__(self, cmd='./trans', jobs=1):
+        self.cmd = cmd
+        self.jobs = jobs
+
+
+    def translate_normalized(self, ja):
+        p = subprocess.Popen([self.cmd, 'ja:', ja.encode('utf8')], stdout=subprocess.PIPE)
+        output = p.communicate()[0]
+        result = output.split('\n')[-2].split(',')[0]
+        return clean_translation(result)[7:-4]
+
+
+    def translate_many(self, captions):
+        if len(captions) <= 1 or self.jobs <= 1:
+            return Translator.translate_many(self, captions)
+        pool = ThreadPool(self.jobs)
+        try:
+            return pool.map(self.translate, captions)
+        finally:
+            pool.close()
+
+
+class WorkerTranslator(Translator):
+    """ keeps one long-lived worker process and streams captions
+        through it (see WORKER PROTOCOL above)
+    """
+    def __init__(self, cmd, timeout=60):
+        self.cmd = cmd
+        self.timeout = timeout   # seconds to wait for each line of output
+        self.proc = None
+        self.pending = ''        # output read past the last full line
+        self.lock = threading.Lock()
+
+
+    def start(self):
+        self.proc = subprocess.Popen(self.cmd, shell=True, bufsize=1,
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.pending = ''
+
+
+    def close(self):
+        if self.proc is not None:
+            try:
+                self.proc.stdin.close()
+                self.proc.wait()
+            except:
+                pass
+            self.proc = None
+
+
+    def kill(self):
+        """ for a worker in an unknown state: it may be wedged, or mid-batch
+        """
+        if self.proc is not None:
+            try:
+                self.proc.kill()
+                self.proc.wait()
+            except:
+                pass
+            self.proc = None
+
+
+    def readline(self):
+        """ the worker's next line of output, waiting at most self.timeout for it.
+            reads the pipe directly, since select can't see a file object's buffer
+        """
+        fd = self.proc.stdout.fileno()
+        deadline = time.time() + self.timeout
+        while '\n' not in self.pending:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise IOError('translation worker timed out after %ds: %s' % (self.timeout, self.cmd))
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise IOError('translation worker exited: %s' % self.cmd)
+            self.pending += chunk
+        line, self.pending = self.pending.split('\n', 1)
+        return line
+
+
+    def translate_normalized(self, ja):
+        return self.run([ja])[0]
+
+
+    def translate_many(self, captions):
+        """ sends the whole batch down the pipe, then reads the answers back
+        """
+        out = [None] * len(captions)
+        batch = []
+        for i, caption in enumerate(captions):
+            try:
+                ja = normalize_ja(caption)
+            except:
+                out[i] = ''
+                continue
+            if len(ja) > 0:
+                batch.append((i, ja))
+        if len(batch) == 0:
+            return out
+
+        try:
+            results = self.run([ja for (_, ja) in batch])
+        except:
+            results = [''] * len(batch)   # run() has killed the worker, it restarts on the next call
+        for (i, _), result in zip(batch, results):
+            out[i] = result
+        return out
+
+
+    def run(self, lines):
+        """ writes lines to the worker and reads one response per line. on any
+            error the worker is killed, so the next call starts a fresh one
+        """
+        data = ''.join((line.encode('utf8') if isinstance(line, unicode) else line).replace('\n', ' ') + '\n'
+                       for line in lines)
+        errors = []
+
+        def feed(stdin):
+            try:
+                stdin.write(data)
+                stdin.flush()
+            except Exception as e:
+                errors.append(e)   # e.g. the worker died; the reads below find out too
+
+        with self.lock:
+            if self.proc is None or self.proc.poll() is not None:
+                self.start()
+            try:
+                # write from a thread so a full stdout pipe can't deadlock us
+                feeder = threading.Thread(target=feed, args=(self.proc.stdin,))
+                feeder.start()
+                results = [clean_translation(self.readline()) for _ in lines]
+                feeder.join()
+                if errors:
+                    raise errors[0]
+                return results
+            except:
+                self.kill()
+                raise
+
+
+class StubTranslator(Translator):
+    """ local translator for tests: looks captions up in a table,
+        falling back to fn(caption) (or the caption itself)
+    """
+    def __init__(self, table=None, fn=None):
+        self.table = table or {}
+        self.fn = fn
+        self.calls = 0
+
+
+    def translate_normalized(self, ja):
+        self.calls += 1
+        if ja in self.table:
+            return self.table[ja]
+        if self.fn is not None:
+            return self.fn(ja)
+        return ja
+
+
+# per-process translators, so every pool worker keeps its own long-lived backend
+TRANSLATORS = {}
+
+
+def get_translator(worker_cmd=None, cache_path=None, cache_size=1000000, jobs=1, timeout=60):
+    """ returns this process's translator: a WorkerTranslator around
+        worker_cmd if one is given (timing out after timeout seconds),
+        otherwise the per-caption CommandTranslator (jobs at a time).
+        with a cache_path, it sits behind a persistent translation cache
+    """
+    spec = (worker_cmd, cache_path, cache_size, jobs, timeout)
+    if spec not in TRANSLATORS:
+        if worker_cmd:
+            translator = WorkerTranslator(worker_cmd, timeout)
+        else:
+            translator = CommandTranslator(jobs=jobs)
+        if cache_path:
+            from translation_cache import CachingTranslator
+            translator = CachingTranslator(translator, cache_path, cache_size)
+        TRANSLATORS[spec] = translator
+    return TRANSLATORS[spec]
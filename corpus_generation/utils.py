@@ -1,41 +1,98 @@
 """
-Utility functions (caption cleaning)
+Utility functions (caption cleaning, caching)
 """
 
 import re
+import collections
+import threading
+
+
+class LRUCache():
+    """ a bounded mapping that evicts the least recently used key.
+        thread-safe (OrderedDict isn't)
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data[key] = value   # move to most-recently-used end
+            self.hits += 1
+            return value
+
+
+    def put(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+    def __contains__(self, key):
+        return key in self.data
+
+
+    def __len__(self):
+        return len(self.data)
+
+
+# clean_caption's patterns, compiled once. they run in the same order as they
+#   always have; patterns only share a pass where that can't change the output
+#   (none of them can create or destroy a match for the others)
+JA_NOISE       = re.compile(u'\uff08.*?\uff09|\u2192')              # ja parens, ja right arrow
+MARKUP         = re.compile(u'[\w ]+:|[*#]|\<.*?\>|{.*?}|\(.*?\)')   # actor names, unwanted chars, brackets
+SITE_SIGNATURE = re.compile(u'.*subtitles.*\n?|.*subs.*\n?', re.IGNORECASE)
+URLS           = re.compile(u'www.*\s\n?|[^\s]*\. ?com\n?')
+MSC            = re.compile(u'[\\\\\t\r]')     # backslashes, tabs, CRs. a literal '\\n' loses its backslash here, as it always has
+WHITESPACE     = re.compile(u'[ \n]+')         # newlines and runs of spaces => one space
+
+CLEAN_CACHE = LRUCache(maxsize=100000)
 
 
 def clean_caption(x):
-    """ cleans a caption
+    """ cleans a caption. .jescidx files store its output, so changes here
+        need a subtitle_index.FORMAT_VERSION bump
     """
-    x = x.strip()                            # strip ends                                                      
-    x = x.lower()                            # lowercase                                                            
-    
-    ja_parens      = re.compile('\xef\xbc\x88.*?\xef\xbc\x89')
-    ja_rightarrow  = re.compile('\xe2\x86\x92')
-    actor          = re.compile('[\w ]+:')
-    unwanted       = re.compile('[*#]')    
-    brackets       = re.compile('\<.*?\>|{.*?}|\(.*?\)')
-    newlines       = re.compile('\\\\n|\n')
-    site_signature = re.compile('.*subtitles.*\n?|.*subs.*\n?', re.IGNORECASE)
-    urls           = re.compile('www.*\s\n?|[^\s]*\. ?com\n?')
-    msc            = re.compile('\\\\|\t|\\\\t|\r|\\\\r')
-    encoding_error = re.compile('0000,0000,0000,\w*?')
-    multi_space    = re.compile('[ ]+')
-
-    # to and from unicode for regex to work
-    x = unicode(ja_parens.sub('', x.encode('utf8')), 'utf8')
-    x = unicode(ja_rightarrow.sub('', x.encode('utf8')), 'utf8')
-    x = actor.sub('', x)
-    x = unwanted.sub('', x)
-    x = brackets.sub('', x)
-    x = site_signature.sub('', x)
-    x = urls.sub('', x)
-    x = msc.sub('', x)
-    x = encoding_error.sub('', x)
-    x = newlines.sub(' ', x)
-    x = multi_space.sub(' ', x)
-    x = x.strip()
-    
-    return x
+    if isinstance(x, str):
+        x = x.decode('utf8')
+    x = x.strip()                            # strip ends
+    x = x.lower()                            # lowercase
+
+    # substring checks skip the passes that can't match (x is lowercase by now)
+    if u'\uff08' in x or u'\u2192' in x:
+        x = JA_NOISE.sub(u'', x)
+    x = MARKUP.sub(u'', x)
+    if u'subs' in x or u'subtitles' in x:
+        x = SITE_SIGNATURE.sub(u'', x)
+    if u'www' in x or u'com' in x:
+        x = URLS.sub(u'', x)
+    x = MSC.sub(u'', x)
+    x = x.replace(u'0000,0000,0000,', u'')   # encoding errors
+    x = WHITESPACE.sub(u' ', x)
+    return x.strip()
 
+
+def clean_caption_cached(x):
+    """ clean_caption, memoized in a bounded lru cache (captions repeat a lot)
+    """
+    out = CLEAN_CACHE.get(x)
+    if out is None:
+        out = clean_caption(x)
+        CLEAN_CACHE.put(x, out)
+    return out